@@ -0,0 +1,102 @@
+import os
+import asyncio
+import random
+import tempfile
+from datetime import datetime, timedelta
+
+from harness import measure
+
+def populate(database, rows: int, seed: int = 0):
+    """Заполнение всех таблиц rows строками"""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    referrers = max(1, rows // 10)
+    today = now.date()
+    with database.get_connection() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO referrals (invited_id, referrer_id, created_at) VALUES (?, ?, ?)",
+            ((1_000_000_000 + i, rng.randrange(referrers), now.isoformat()) for i in range(rows))
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO referral_counts (referrer_id, count) "
+            "SELECT referrer_id, COUNT(*) FROM referrals GROUP BY referrer_id"
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO bonus_messages (user_id, bonus_count, updated_at) VALUES (?, ?, ?)",
+            ((i, rng.randrange(100), now.isoformat()) for i in range(rows))
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO daily_counters (user_id, date, count) VALUES (?, ?, ?)",
+            ((i // 7, (today - timedelta(days=i % 7)).isoformat(), rng.randrange(40)) for i in range(rows))
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO conversation_contexts (chat_id, user_id, history, summary, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            ((i % 50, i, '[{"role": "user", "content": "привет"}]', "", now.isoformat()) for i in range(rows))
+        )
+
+def run(sizes, workdir: str = None) -> dict:
+    import database
+    import quota
+    from state import LocalStateBackend
+
+    results = {}
+    workdir = workdir or tempfile.mkdtemp(prefix="bench_db_")
+    for rows in sizes:
+        database.close_connections()
+        database.DB_FILE = os.path.join(workdir, f"bench_{rows}.db")
+        if os.path.exists(database.DB_FILE):
+            os.remove(database.DB_FILE)
+        database.init_db()
+        populate(database, rows)
+
+        rng = random.Random(rows)
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+        users = lambda: rng.randrange(rows)
+        history = [{"role": "user", "content": "Имя: привет"}, {"role": "assistant", "content": "Привет."}]
+        counter = iter(range(10 ** 9))
+        old_date = (datetime.utcnow().date() - timedelta(days=30)).isoformat()
+        contexts = [(i % 50, users(), history, "") for i in range(50)]
+
+        def seed_old_counters(batch: int = 1000):
+            # Каждый вызов очистки должен находить полную порцию устаревших строк
+            start = 3_000_000_000 + next(counter) * batch
+            with database.get_connection() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO daily_counters (user_id, date, count) VALUES (?, ?, ?)",
+                    ((start + i, old_date, 1) for i in range(batch))
+                )
+
+        prefix = f"db.{rows}."
+        cases = {
+            "get_referral_count": lambda: database.get_referral_count(rng.randrange(max(1, rows // 10))),
+            "get_referrer_id": lambda: database.get_referrer_id(1_000_000_000 + users()),
+            "get_bonus_count": lambda: database.get_bonus_count(users()),
+            "set_bonus_count": lambda: database.set_bonus_count(users(), 5),
+            "get_daily_counter": lambda: database.get_daily_counter(users() // 7, today),
+            "increment_daily_counter": lambda: database.increment_daily_counter(users() // 7, today),
+            "add_referral": lambda: database.add_referral(2_000_000_000 + next(counter), users()),
+            "load_context": lambda: database.load_context(users() % 50, users()),
+            "save_context": lambda: database.save_context(users() % 50, users(), history),
+            "save_contexts": lambda: database.save_contexts(contexts),
+            "has_context": lambda: database.has_context(users()),
+            "delete_context": lambda: database.delete_context(users() % 50, users()),
+            "apply_bonus_batch": lambda: database.apply_bonus_batch(f"bench:{next(counter)}", [(users(), 1)]),
+            "check_database": database.check_database,
+        }
+        for name, func in cases.items():
+            results[prefix + name] = measure(func)
+        results[prefix + "cleanup_old_counters"] = measure(database.cleanup_old_counters, setup=seed_old_counters)
+
+        # Резервирование сообщения, как в обработчике: без кэша квот (холодное) и с кэшем (теплое).
+        # Теплый замер возвращает списанное перед каждым вызовом, чтобы не упереться в лимит
+        loop = asyncio.new_event_loop()
+        backend = LocalStateBackend()
+        reserve = lambda user_id: loop.run_until_complete(backend.reserve_message(user_id))
+        refund = lambda: loop.run_until_complete(backend.refund_message(1, today))
+        results[prefix + "reserve_message.cold"] = measure(lambda: reserve(users()), setup=quota.quota_cache.clear)
+        results[prefix + "reserve_message.warm"] = measure(lambda: reserve(1), setup=refund)
+        loop.close()
+
+    database.close_connections()
+    return results
@@ -0,0 +1,49 @@
+import random
+
+from harness import measure
+
+def reasoning_output(seed: int = 0, think_paragraphs: int = 40, answer_paragraphs: int = 6) -> str:
+    """Синтетический ответ reasoning-модели: длинный <think> и ответ с абзацами и действиями"""
+    rng = random.Random(seed)
+    words = (
+        "Алиса пользователь вопрос ответ думаю нужно сказать коротко грубо но мило "
+        "контекст история сообщение чат имя смысл сарказм шутка пожалуй впрочем"
+    ).split()
+
+    def sentence():
+        return " ".join(rng.choice(words) for _ in range(rng.randint(6, 16))).capitalize() + rng.choice([".", "!", "?", "…"])
+
+    def paragraph():
+        return "  ".join(sentence() for _ in range(rng.randint(2, 6)))
+
+    think = "\n\n".join(paragraph() for _ in range(think_paragraphs))
+    answer = "\n\n\n".join(
+        f"*{rng.choice(words)}* " + paragraph() for _ in range(answer_paragraphs)
+    )
+    # Незавершенное предложение в конце и служебный тег
+    return f"<think>\n{think}\n</think>\n\n{answer} и еще{'</s>'}"
+
+def chunks(text: str, size: int = 20) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def run() -> dict:
+    import bot
+
+    raw = reasoning_output()
+    stripped = bot.strip_reasoning(raw)
+    normalized = stripped.strip()
+    stream_chunks = chunks(raw)
+
+    def stream():
+        cleaner = bot.StreamingCleaner()
+        for chunk in stream_chunks:
+            cleaner.feed(chunk)
+        cleaner.preview()
+
+    return {
+        "text.strip_reasoning": measure(lambda: bot.strip_reasoning(raw)),
+        "text.complete_sentences": measure(lambda: bot.complete_sentences(normalized)),
+        "text.format_paragraphs": measure(lambda: bot.format_paragraphs(normalized)),
+        "text.clean_response": measure(lambda: bot.clean_response(raw)),
+        "text.streaming_cleaner": measure(stream),
+    }
@@ -0,0 +1,41 @@
+import time
+import statistics
+
+# Минимальное время одного замера и число замеров
+MIN_ROUND_TIME = 0.2
+ROUNDS = 5
+
+def measure(func, setup=None, min_round_time: float = MIN_ROUND_TIME, rounds: int = ROUNDS) -> float:
+    """
+    Медианное время одного вызова func (в секундах).
+    setup вызывается перед каждым вызовом и в замер не входит.
+    """
+    # Подбор числа вызовов на один замер
+    iterations = 1
+    while True:
+        elapsed = _run(func, setup, iterations)
+        if elapsed >= min_round_time or iterations >= 1_000_000:
+            break
+        iterations *= 10 if elapsed < min_round_time / 10 else 2
+
+    samples = [_run(func, setup, iterations) / iterations for _ in range(rounds)]
+    return statistics.median(samples)
+
+def _run(func, setup, iterations: int) -> float:
+    total = 0.0
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        total += time.perf_counter() - started
+    return total
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Список регрессий: (имя, базовое время, текущее время)"""
+    regressions = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base and value > base * (1 + threshold):
+            regressions.append((name, base, value))
+    return regressions
@@ -0,0 +1,88 @@
+"""
+Микробенчмарки текстового конвейера и слоя БД.
+
+    python benchmarks/run.py                      # замер и сравнение с baseline.json
+    python benchmarks/run.py --save               # сохранить результаты как новый baseline
+    python benchmarks/run.py --sizes 10000 --only db
+
+Результаты (секунды на вызов, медиана) пишутся в JSON. Если замер
+медленнее baseline больше чем на --threshold, процесс завершается с кодом 1.
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+
+def main():
+    parser = argparse.ArgumentParser(description="Alisa microbenchmarks")
+    parser.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=list(DEFAULT_SIZES))
+    parser.add_argument("--only", choices=("text", "db"), default=None)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--output", default=None, help="куда записать результаты (JSON)")
+    parser.add_argument("--save", action="store_true", help="записать результаты в baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое замедление (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    # Временная БД до импорта database.py (init_db выполняется при импорте)
+    workdir = tempfile.mkdtemp(prefix="alisa_bench_")
+    os.environ.setdefault("DB_FILE", os.path.join(workdir, "import.db"))
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, HERE)
+    os.chdir(ROOT)
+
+    # Журнал INFO на каждом вызове искажает замеры
+    logging.disable(logging.INFO)
+
+    from harness import compare
+    import bench_text
+    import bench_db
+
+    results = {}
+    if args.only in (None, "text"):
+        results.update(bench_text.run())
+    if args.only in (None, "db"):
+        results.update(bench_db.run(args.sizes, workdir))
+
+    report = {
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+    for name, value in sorted(results.items()):
+        print(f"{name:55s} {value * 1e6:12.2f} us")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found, run with --save to create one")
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    for name, base, value in regressions:
+        print(f"REGRESSION {name}: {base * 1e6:.2f} us -> {value * 1e6:.2f} us")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,15 +5,18 @@ import threading
 import time
 import re
 import random
-from datetime import datetime, timedelta
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import signal
+import hashlib
+import multiprocessing
 from telegram import (
+    Bot,
     Update, 
     InlineKeyboardButton, 
     InlineKeyboardMarkup, 
     BotCommand,
     constants
 )
+from telegram.error import BadRequest, Conflict
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -23,16 +26,40 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler
 )
-from database import (
-    add_referral,
-    get_referrer_id,
-    get_referral_count,
-    set_bonus_count,
-    get_bonus_count,
-    increment_daily_counter,
-    get_daily_counter,
-    cleanup_old_counters
+from quota import (
+    BASE_LIMIT,
+    parse_bonus_lines
 )
+from state import state
+from maintenance import maintenance_worker
+from send_queue import send_queue
+from update_processor import ChatOrderedUpdateProcessor, CONCURRENT_UPDATES, shard_index
+from prompt import (
+    build_prompt,
+    split_history,
+    fold_due,
+    cap_history,
+    build_summary_request,
+    SUMMARY_MAX_CHARS
+)
+from response_cache import (
+    response_cache,
+    text_hash,
+    RESPONSE_CACHE_ENABLED
+)
+from scheduler import LLMScheduler
+from llm_router import llm_router
+from metrics import Counter, Gauge, Histogram
+from web import (
+    readiness,
+    run_http_server,
+    set_update_handler,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET
+)
+from resilience import ProviderUnavailable
+import tracing
+from tracing import trace_exporter
 
 # Настройка логгирования
 logging.basicConfig(
@@ -46,18 +73,83 @@ TOKEN = os.getenv("TG_TOKEN")
 NOVITA_API_KEY = os.getenv("NOVITA_API_KEY")
 BOT_USERNAME = os.getenv("BOT_USERNAME", "@aliceneyrobot")
 
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+
+# Число рабочих процессов в режиме вебхука: обновления распределяются по chat_id
+# (больше одного - только с общим хранилищем состояния STATE_BACKEND=redis)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", 1))
+
+# Сколько ждать провайдера LLM при старте, прежде чем продолжить без него
+STARTUP_PROVIDER_TIMEOUT = float(os.getenv("STARTUP_PROVIDER_TIMEOUT", 10))
+
 # Идентификатор разработчика
 DEVELOPER_ID = 1040929628
 
 # Идентификатор чата без ограничений
 UNLIMITED_CHAT_ID = -1001481824277
 
+# Вес очереди безлимитного чата в планировщике запросов к LLM
+UNLIMITED_CHAT_WEIGHT = int(os.getenv("UNLIMITED_CHAT_WEIGHT", 2))
+
+# Общая очередь планировщика для запросов резюме всех диалогов: вместе они
+# получают долю одного чата и учитываются в общем лимите параллельности
+SUMMARY_LANE = "summary"
+
+# Окно объединения сообщений в групповых чатах (секунды, 0 - выключено):
+# упоминания бота разными участниками в пределах окна идут в LLM одним запросом
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 0))
+COALESCE_CHATS = {
+    int(chat_id) for chat_id in os.getenv("COALESCE_CHATS", str(UNLIMITED_CHAT_ID)).split(",") if chat_id.strip()
+}
+
 # Состояния для ConversationHandler разработчика
 SELECT_USER, SELECT_ACTION, INPUT_AMOUNT = range(3)
 
+# Максимальный размер файла пакетного начисления бонусов (байт)
+BONUS_FILE_MAX_SIZE = 1024 * 1024
+
+# Сколько строк отчета о пакетном начислении показывать в сообщении
+BONUS_REPORT_LINES = 30
+
+# Потоковая выдача ответов: интервалы редактирования укладываются в лимиты Telegram
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL_PRIVATE = float(os.getenv("STREAM_EDIT_INTERVAL_PRIVATE", 1.5))
+STREAM_EDIT_INTERVAL_GROUP = float(os.getenv("STREAM_EDIT_INTERVAL_GROUP", 3.5))
+STREAM_MIN_DELTA = 30
+
+# Ответ на случай пустого результата очистки
+EMPTY_RESPONSE_TEXT = "Я обдумываю твой вопрос... Попробуй спросить по-другому."
+
+# Ответ, пока провайдер LLM недоступен (запрос не списывается)
+PROVIDER_UNAVAILABLE_TEXT = (
+    "Алиса сейчас не может ответить: сервис перегружен. "
+    "Попробуй чуть позже - это сообщение не списано с твоего лимита."
+)
+
 # Глобальные переменные
-user_contexts = {}
-last_cleanup_time = time.time()
+summary_tasks = {}
+# Запись истории диалога ответом и сворачиванием в резюме идет под замком ключа
+context_locks = [asyncio.Lock() for _ in range(64)]
+llm_scheduler = LLMScheduler(weights={UNLIMITED_CHAT_ID: UNLIMITED_CHAT_WEIGHT})
+
+# Метрики обработки сообщений
+HANDLE_MESSAGE_SECONDS = Histogram(
+    "handle_message_seconds",
+    "End-to-end handle_message latency",
+    ("result",)
+)
+LIMIT_DENIALS = Counter("limit_denials_total", "Messages rejected by the daily limit")
+IGNORED_GROUP_MESSAGES = Counter("ignored_group_messages_total", "Group messages not addressed to the bot")
+CLEANED_RESPONSES = Counter("cleaned_responses_total", "LLM responses after clean_response", ("result",))
+Gauge("llm_in_flight", "LLM turns currently running", callback=lambda: llm_scheduler.in_flight)
+Gauge("llm_queue_depth", "LLM turns waiting in the scheduler", callback=lambda: llm_scheduler.queued)
+
+# Обработчик обновлений: параллельно для разных чатов, по порядку внутри чата
+update_processor = ChatOrderedUpdateProcessor(CONCURRENT_UPDATES)
+Gauge("updates_in_flight", "Telegram updates being processed", callback=lambda: update_processor.running)
+Gauge("ordered_chats", "Chats with updates processing or waiting", callback=lambda: update_processor.ordered_keys)
 
 # Список эмодзи для использования
 EMOJI_LIST = ["😊", "😂", "😍", "🤔", "😎", "👍", "❤️", "✨", "🎉", "💔"]
@@ -80,80 +172,30 @@ except Exception as e:
               "Всегда завершай сообщение полностью. " \
               "Форматируй ответы с абзацами и отступами, где это уместно."
 
-# Функция проверки лимита сообщений
-
-# ---------- VoAPI compatibility layer (injected) ----------
-import os
-import requests
+# Хэш персонажа входит в ключ кэша ответов
+PERSONA_HASH = text_hash(PERSONA)
 
-VOAPI_API_URL = os.environ.get("VOAPI_API_URL", "https://openrouter.ai/api/v1")
-VOAPI_API_KEY = os.environ.get("VOAPI_API_KEY", os.environ.get("NOVITA_API_KEY", ""))  # fallback
-LLM_MODEL = os.environ.get("LLM_MODEL", "deepseek/deepseek-r1-0528:free")
+# Чаты, где сообщения разных участников объединяются в общий ход
+def is_coalescing_chat(chat_id: int) -> bool:
+    return COALESCE_WINDOW > 0 and chat_id in COALESCE_CHATS
 
-def query_chat_voapi(messages, timeout=60):
-    """
-    Make a POST to an OpenAI-compatible chat endpoint on VoAPI.
-    Returns the assistant text or raises an exception.
-    """
-    url = VOAPI_API_URL.rstrip('/') + "/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {VOAPI_API_KEY}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "model": LLM_MODEL,
-        "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 800,
-    }
-    resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
-    resp.raise_for_status()
-    data = resp.json()
-    # Try OpenAI-compatible response shape
-    if isinstance(data, dict):
-        # choices -> message -> content
-        try:
-            return data["choices"][0]["message"]["content"]
-        except Exception:
-            # fallback: choices[0].text
-            try:
-                return data["choices"][0]["text"]
-            except Exception:
-                # return full json if nothing matched
-                return json.dumps(data, ensure_ascii=False)
-    return str(data)
-# ---------- end of injection ----------
+# Ключ диалога: (chat_id, user_id), а в чатах с объединением - общий для чата (chat_id, 0)
+def conversation_key(chat_id: int, user_id: int) -> tuple:
+    if is_coalescing_chat(chat_id):
+        return (chat_id, 0)
+    return (chat_id, user_id)
 
-def check_message_limit(user_id: int) -> bool:
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    
-    # Очистка старых записей перед проверкой
-    global last_cleanup_time
-    current_time = time.time()
-    if current_time - last_cleanup_time > 1800:
-        cleanup_old_counters()
-        last_cleanup_time = current_time
-    
-    # Базовый лимит
-    base_limit = 35
-    
-    # Бонус за рефералов
-    referral_bonus = get_referral_count(user_id) * 3
-    
-    # Постоянные бонусные сообщения
-    bonus_messages = get_bonus_count(user_id)
-    
-    # Общий доступный лимит
-    total_limit = base_limit + referral_bonus + bonus_messages
-    
-    # Получение текущего счетчика
-    current_count = get_daily_counter(user_id, today)
-    
-    # Проверка лимита
-    if current_count >= total_limit:
-        return False
-    
-    return True
+# Текст хода в формате "Имя: текст"; подряд идущие сообщения одного участника склеиваются
+def format_turn(items: list) -> str:
+    lines = []
+    previous_user = None
+    for item in items:
+        if item.from_user.id == previous_user:
+            lines.append(item.text)
+        else:
+            lines.append(f"{item.from_user.full_name}: {item.text}")
+            previous_user = item.from_user.id
+    return "\n".join(lines)
 
 # Функция для форматирования действий
 def format_actions(text: str) -> str:
@@ -191,11 +233,17 @@ def format_paragraphs(text: str) -> str:
     
     return '\n\n'.join(formatted)
 
-# Функция для очистки ответа
-def clean_response(response: str) -> str:
+# Функция для удаления рассуждений и служебных тегов модели
+def strip_reasoning(response: str) -> str:
     cleaned = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
     cleaned = cleaned.replace('<think>', '').replace('</think>', '')
     cleaned = cleaned.replace('</s>', '').replace('<s>', '')
+    return cleaned
+
+# Функция для очистки ответа
+@tracing.traced()
+def clean_response(response: str) -> str:
+    cleaned = strip_reasoning(response)
     
     cleaned = format_actions(cleaned)
     cleaned = re.sub(r'\n\s*\n', '\n\n', cleaned).strip()
@@ -205,24 +253,221 @@ def clean_response(response: str) -> str:
     
     return cleaned
 
-# HTTP-сервер для проверки работоспособности
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'Service is alive')
+# Служебные теги, которые вырезаются из потока на лету
+STREAM_TAGS = ('<think>', '</think>', '<s>', '</s>')
+
+def _partial_tag_length(text: str, tags) -> int:
+    """Длина хвоста text, который может оказаться началом одного из тегов"""
+    longest = 0
+    for tag in tags:
+        for size in range(1, min(len(tag), len(text) + 1)):
+            if text.endswith(tag[:size]):
+                longest = max(longest, size)
+    return longest
+
+# Инкрементальная очистка потокового ответа
+class StreamingCleaner:
+    """
+    Инкрементальная форма clean_response: принимает фрагменты потока,
+    вырезает <think>…</think> на лету и отдает видимый текст для предпросмотра.
+    Теги, разорванные между фрагментами, придерживаются до следующего фрагмента.
+    """
+
+    def __init__(self):
+        self.raw = ''
+        self.visible = ''
+        self._buffer = ''
+        self._in_think = False
+
+    def feed(self, chunk: str) -> str:
+        """Добавление фрагмента, возвращает новый видимый текст"""
+        self.raw += chunk
+        self._buffer += chunk
+        out = []
+        
+        while self._buffer:
+            if self._in_think:
+                end = self._buffer.find('</think>')
+                if end == -1:
+                    keep = _partial_tag_length(self._buffer, ('</think>',))
+                    self._buffer = self._buffer[len(self._buffer) - keep:] if keep else ''
+                    break
+                self._buffer = self._buffer[end + len('</think>'):]
+                self._in_think = False
+                continue
+            
+            start = self._buffer.find('<')
+            if start == -1:
+                out.append(self._buffer)
+                self._buffer = ''
+                break
+            
+            out.append(self._buffer[:start])
+            self._buffer = self._buffer[start:]
+            
+            tag = next((t for t in STREAM_TAGS if self._buffer.startswith(t)), None)
+            if tag:
+                self._buffer = self._buffer[len(tag):]
+                if tag == '<think>':
+                    self._in_think = True
+            elif any(t.startswith(self._buffer) for t in STREAM_TAGS):
+                # Начало тега еще не пришло целиком
+                break
+            else:
+                out.append('<')
+                self._buffer = self._buffer[1:]
+        
+        new_text = ''.join(out)
+        self.visible += new_text
+        return new_text
+
+    def preview(self) -> str:
+        """Промежуточный текст для редактирования сообщения"""
+        cleaned = re.sub(r'\n\s*\n', '\n\n', self.visible).strip()
+        return format_paragraphs(cleaned)
+
+    def finish(self) -> str:
+        """Итоговый текст - полный clean_response по всему ответу"""
+        return clean_response(self.raw)
+
+# Безопасное редактирование сообщения при потоковой выдаче
+async def edit_stream_message(sent_message, text: str):
+    try:
+        await send_queue.edit(sent_message, text[:constants.MessageLimit.MAX_TEXT_LENGTH])
+    except BadRequest as e:
+        # Telegram отвечает ошибкой, если текст не изменился
+        if "not modified" not in str(e).lower():
+            raise
+
+def _sent(future) -> bool:
+    return future.done() and not future.cancelled() and future.exception() is None
+
+# Потоковый ответ с постепенным редактированием сообщения.
+# Отправка не ожидается: возвращается (текст, корутина доставки), которую
+# вызывающий ждет уже после освобождения слота планировщика LLM
+async def stream_reply(message, messages):
+    cleaner = StreamingCleaner()
+    is_private = message.chat.type == "private"
+    interval = STREAM_EDIT_INTERVAL_PRIVATE if is_private else STREAM_EDIT_INTERVAL_GROUP
+    
+    sent = None
+    shown_text = ""
+    last_edit = 0.0
     
-    def do_HEAD(self):
-        self.send_response(200)
-        self.end_headers()
+    async for chunk in llm_router.stream_chat(messages):
+        if not cleaner.feed(chunk):
+            continue
+        
+        preview = cleaner.preview()
+        if not preview:
+            continue
+        
+        now = time.monotonic()
+        if sent is None:
+            # Первое сообщение ставится в очередь сразу с первыми видимыми токенами
+            sent = send_queue.reply(message, preview[:constants.MessageLimit.MAX_TEXT_LENGTH])
+            shown_text = preview
+            last_edit = now
+        elif _sent(sent) and now - last_edit >= interval and len(preview) - len(shown_text) >= STREAM_MIN_DELTA:
+            # Промежуточные правки не задерживают чтение потока: очередь
+            # отправит их с учетом лимитов, устаревшие правки заменяются новыми
+            send_queue.edit(sent.result(), preview[:constants.MessageLimit.MAX_TEXT_LENGTH])
+            shown_text = preview
+            last_edit = now
+    
+    final_text = cleaner.finish()
+    if not final_text.strip():
+        CLEANED_RESPONSES.inc(result="empty")
+        final_text = EMPTY_RESPONSE_TEXT
+    else:
+        CLEANED_RESPONSES.inc(result="ok")
+    
+    return final_text, deliver_stream(message, sent, shown_text, final_text)
 
-def run_http_server(port=8080):
-    server_address = ('', port)
-    httpd = HTTPServer(server_address, HealthHandler)
-    logger.info(f"Starting HTTP health check server on port {port}")
-    httpd.serve_forever()
+# Завершение доставки потокового ответа: итоговый текст отправляется или заменяет показанный
+async def deliver_stream(message, sent, shown_text: str, final_text: str):
+    if sent is None:
+        await send_queue.reply(message, final_text)
+        return
+    sent_message = await sent
+    if final_text != shown_text:
+        await edit_stream_message(sent_message, final_text)
 
+def context_lock(key) -> asyncio.Lock:
+    return context_locks[hash(key) % len(context_locks)]
+
+# Сворачивание выпавших из окна реплик в краткое содержание диалога.
+# Реплики остаются в истории, пока новое резюме не сохранено: при ошибке
+# они будут свернуты следующей задачей
+async def fold_into_summary(key, keep: int):
+    # Резюме одного диалога обновляются строго по очереди
+    previous = summary_tasks.get(key)
+    current = asyncio.current_task()
+    summary_tasks[key] = current
+    try:
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+        
+        # В окне остаются последние keep записей, сворачивается все, что старше
+        history = await state.get_context(key)
+        turns = history[:max(0, len(history) - keep)]
+        if not turns:
+            return
+        
+        summary = await state.get_summary(key)
+        async with llm_scheduler.submit((SUMMARY_LANE, key), SUMMARY_LANE, turns):
+            response = await llm_router.chat(build_summary_request(summary, turns))
+        new_summary = re.sub(r'\s+', ' ', strip_reasoning(response)).strip()
+        if not new_summary:
+            return
+        
+        async with context_lock(key):
+            # За время запроса история могла быть очищена (/clear) - тогда резюме не нужно
+            history = await state.get_context(key)
+            if history[:len(turns)] == turns:
+                await state.set_context(key, history[len(turns):], new_summary[:SUMMARY_MAX_CHARS])
+    except Exception as e:
+        logger.error(f"Ошибка обновления краткого содержания диалога {key}: {e}")
+    finally:
+        if summary_tasks.get(key) is current:
+            del summary_tasks[key]
+
+# Фильтр сообщений, адресованных боту
+class AddressedToBotFilter(filters.MessageFilter):
+    """
+    Пропускает личные сообщения, а в группах - только ответы на сообщения бота,
+    упоминания @username и сообщения с именем бота в тексте.
+    Имя бота задается один раз при старте, проверка идет по скомпилированному шаблону.
+    """
+
+    def __init__(self, username: str):
+        super().__init__(name="AddressedToBot")
+        self.set_username(username)
+
+    def set_username(self, username: str):
+        self.username = username.lstrip('@')
+        # Упоминание @username тоже содержит имя, поэтому достаточно одного шаблона
+        self._pattern = re.compile(re.escape(self.username), re.IGNORECASE)
+
+    def filter(self, message) -> bool:
+        with tracing.span("filter.addressed_to_bot"):
+            return self._addressed(message)
+
+    def _addressed(self, message) -> bool:
+        if message.chat.type == constants.ChatType.PRIVATE:
+            return True
+        
+        reply = message.reply_to_message
+        if reply and reply.from_user and reply.from_user.username == self.username:
+            return True
+        
+        if message.text and self._pattern.search(message.text):
+            return True
+        
+        IGNORED_GROUP_MESSAGES.inc()
+        return False
+
+addressed_to_bot = AddressedToBotFilter(BOT_USERNAME)
 
 # Обработчик команды /buy
 async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -240,7 +485,7 @@ async def buy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "то вы можете связаться напрямую с разработчиком - <a href='https://t.me/odinnadsat'>odinnadsat</a>"
     )
     
-    await update.message.reply_text(text, parse_mode="HTML")
+    await send_queue.reply(update.message, text, parse_mode="HTML")
 
 # Обработчики команд
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -248,11 +493,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if context.args and context.args[0].isdigit():
         referrer_id = int(context.args[0])
-        if referrer_id != user.id and not get_referrer_id(user.id):
-            add_referral(user.id, referrer_id)
+        if referrer_id != user.id and not await state.get_referrer_id(user.id):
+            await state.add_referral(user.id, referrer_id)
             logger.info(f"New referral: user {user.id} invited by {referrer_id}")
     
-    await update.message.reply_text(
+    await send_queue.reply(update.message, 
         "Привет, меня зовут Алиса, если посмеешь относиться ко мне неуважительно то получишь пару крепких ударов!\n\n"
         "/info - информация обо мне и как правильно ко мне обращаться.\n"
         "/stat - узнать свой статус и оставшиеся сообщения\n"
@@ -266,7 +511,7 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.message.reply_text(
+    await send_queue.reply(update.message, 
         "❗️Здесь вы можете ознакомиться с правилами использования нашего бота.\n"
         "Рекомендуем прочитать перед использованием.",
         reply_markup=reply_markup
@@ -274,18 +519,15 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def ref_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    bot_username = (await context.bot.get_me()).username
+    bot_username = context.bot.username
     ref_link = f"https://t.me/{bot_username}?start={user.id}"
-    count = get_referral_count(user.id)
     
     # Рассчитать общий доступный лимит для пользователя
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    base_limit = 35
-    referral_bonus = count * 3
-    bonus_messages = get_bonus_count(user.id)
-    total_limit = base_limit + referral_bonus + bonus_messages
+    quota = await state.get_quota(user.id)
+    count = quota.referrals
+    total_limit = quota.total_limit
     
-    await update.message.reply_text(
+    await send_queue.reply(update.message, 
         f"👥 <b>Ваша реферальная программа</b>\n\n"
         f"• Ваша ссылка: <code>{ref_link}</code>\n"
         f"• Приглашено пользователей: {count}\n"
@@ -299,29 +541,28 @@ async def ref_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def clear_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     chat_id = update.message.chat_id
-    key = (chat_id, user.id)
+    key = conversation_key(chat_id, user.id)
     
-    if key in user_contexts:
-        del user_contexts[key]
+    if await state.delete_context(key):
         logger.info(f"Context cleared for user {user.full_name} in chat {chat_id}")
-        await update.message.reply_text("История диалога очищена. Начнем заново!")
+        await send_queue.reply(update.message, "История диалога очищена. Начнем заново!")
     else:
-        await update.message.reply_text("У тебя еще нет истории диалога со мной!")
+        await send_queue.reply(update.message, "У тебя еще нет истории диалога со мной!")
 
 async def stat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    today = datetime.utcnow().strftime("%Y-%m-%d")
     
-    has_context = any(ctx_key[1] == user.id for ctx_key in user_contexts.keys())
+    has_context = await state.has_context(user.id)
     
-    used_messages = get_daily_counter(user.id, today)
+    quota = await state.get_quota(user.id)
+    used_messages = quota.used
     
-    base_limit = 35
-    referral_count = get_referral_count(user.id)
-    referral_bonus = referral_count * 3
-    bonus_messages = get_bonus_count(user.id)
-    total_limit = base_limit + referral_bonus + bonus_messages
-    remaining = max(0, total_limit - used_messages)
+    base_limit = BASE_LIMIT
+    referral_count = quota.referrals
+    referral_bonus = quota.referral_bonus
+    bonus_messages = quota.bonus
+    total_limit = quota.total_limit
+    remaining = quota.remaining
     
     # Проверяем, является ли чат безлимитным
     is_unlimited = update.message.chat_id == UNLIMITED_CHAT_ID
@@ -343,7 +584,7 @@ async def stat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"💎 Купить дополнительные запросы: /buy"
     )
     
-    await update.message.reply_text(message, parse_mode="HTML")
+    await send_queue.reply(update.message, message, parse_mode="HTML")
 
 # Обработчик команды /dev
 async def dev(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -351,12 +592,14 @@ async def dev(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if user.id != DEVELOPER_ID:
         logger.warning(f"User {user.id} tried to access dev command")
-        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        await send_queue.reply(update.message, "У вас нет прав для использования этой команды.")
         return
     
-    await update.message.reply_text(
+    await send_queue.reply(update.message, 
         "🔧 <b>Режим разработчика</b>\n\n"
-        "Введите ID пользователя, с которым хотите работать:",
+        "Введите ID пользователя, с которым хотите работать, "
+        "или отправьте CSV/текстовый файл со строками <code>user_id,delta</code> "
+        "для пакетного начисления бонусов:",
         parse_mode="HTML"
     )
     
@@ -367,7 +610,7 @@ async def select_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_input = update.message.text.strip()
     
     if not user_input.isdigit():
-        await update.message.reply_text("❌ ID пользователя должен быть числом. Попробуйте еще раз:")
+        await send_queue.reply(update.message, "❌ ID пользователя должен быть числом. Попробуйте еще раз:")
         return SELECT_USER
     
     user_id = int(user_input)
@@ -379,7 +622,7 @@ async def select_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await update.message.reply_text(
+    await send_queue.reply(update.message, 
         f"👤 Выбран пользователь с ID: {user_id}\n"
         "Выберите действие:",
         reply_markup=reply_markup
@@ -408,92 +651,149 @@ async def input_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_input = update.message.text.strip()
     
     if not user_input.isdigit():
-        await update.message.reply_text("❌ Количество сообщений должно быть числом. Попробуйте еще раз:")
+        await send_queue.reply(update.message, "❌ Количество сообщений должно быть числом. Попробуйте еще раз:")
         return INPUT_AMOUNT
     
     amount = int(user_input)
     target_user_id = context.user_data['target_user_id']
     action = context.user_data['action']
     
-    # Работа с постоянными бонусами
-    current_bonus = get_bonus_count(target_user_id)
-    
-    if action == "add_messages":
-        new_bonus = current_bonus + amount
-        set_bonus_count(target_user_id, new_bonus)
-        action_result = "добавлены"
-    else:
-        new_bonus = max(0, current_bonus - amount)
-        set_bonus_count(target_user_id, new_bonus)
-        action_result = "убраны"
+    # Работа с постоянными бонусами: атомарное приращение с записью в журнал
+    # (ключ по update_id защищает от повторной доставки того же обновления)
+    delta = amount if action == "add_messages" else -amount
+    action_result = "добавлены" if action == "add_messages" else "убраны"
+    try:
+        results = await state.apply_bonus_batch(f"update:{update.update_id}", [(target_user_id, delta)], source="dev")
+    except Exception as e:
+        logger.error(f"Error changing bonus messages for user {target_user_id}: {e}")
+        await send_queue.reply(update.message, "❌ Не удалось изменить бонусы, попробуйте еще раз:")
+        return INPUT_AMOUNT
+    quota = await state.get_quota(target_user_id)
+    new_bonus = results[0][2] if results else quota.bonus
+    # Баланс не уходит в минус: сообщаем фактически измененное количество
+    changed = abs(results[0][1]) if results else amount
     
-    base_limit = 35
-    referral_bonus = get_referral_count(target_user_id) * 3
+    base_limit = BASE_LIMIT
+    referral_bonus = quota.referral_bonus
     total_limit = base_limit + referral_bonus + new_bonus
     
     report = (
         f"✅ Успешно!\n\n"
         f"• Пользователь ID: {target_user_id}\n"
-        f"• Действие: {action_result} {amount} бонусных сообщений\n"
+        f"• Действие: {action_result} {changed} бонусных сообщений\n"
         f"• Текущие бонусные сообщения: {new_bonus}\n"
         f"• Общий доступный лимит: {total_limit} ({base_limit} базовых + {referral_bonus} реферальных + {new_bonus} бонусных)"
     )
     
-    await update.message.reply_text(report)
+    await send_queue.reply(update.message, report)
+    return ConversationHandler.END
+
+# Пакетное начисление бонусов из файла со строками "user_id,delta"
+async def bulk_bonus_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    
+    if document.file_size and document.file_size > BONUS_FILE_MAX_SIZE:
+        await send_queue.reply(update.message, "❌ Файл слишком большой. Попробуйте еще раз:")
+        return SELECT_USER
+    
+    telegram_file = await document.get_file()
+    content = bytes(await telegram_file.download_as_bytearray())
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await send_queue.reply(update.message, "❌ Файл должен быть в кодировке UTF-8. Попробуйте еще раз:")
+        return SELECT_USER
+    
+    entries, errors = parse_bonus_lines(text)
+    if errors:
+        lines = "\n".join(f"• строка {number}: {line[:50]}" for number, line in errors[:BONUS_REPORT_LINES])
+        await send_queue.reply(update.message, 
+            f"❌ Не удалось разобрать {len(errors)} строк, файл не применен:\n{lines}\n\n"
+            "Исправьте файл и отправьте его еще раз:"
+        )
+        return SELECT_USER
+    if not entries:
+        await send_queue.reply(update.message, "❌ В файле нет строк вида user_id,delta. Попробуйте еще раз:")
+        return SELECT_USER
+    
+    # Ключ идемпотентности - хэш содержимого: повторная загрузка того же файла не начислит бонусы дважды
+    batch_key = "file:" + hashlib.sha256(content).hexdigest()
+    try:
+        results = await state.apply_bonus_batch(batch_key, entries, source=document.file_name or "")
+    except Exception as e:
+        logger.error(f"Error applying bulk bonus batch {batch_key}: {e}")
+        await send_queue.reply(update.message, "❌ Не удалось применить файл, бонусы не изменены. Попробуйте еще раз:")
+        return SELECT_USER
+    if results is None:
+        await send_queue.reply(update.message, "⚠️ Этот файл уже был применен ранее, бонусы не изменены.")
+        return ConversationHandler.END
+    
+    # Итоги по фактическим изменениям (списание ограничено текущим балансом)
+    added = sum(applied for _, applied, _ in results if applied > 0)
+    removed = -sum(applied for _, applied, _ in results if applied < 0)
+    users = len({user_id for user_id, _, _ in results})
+    lines = "\n".join(
+        f"• {user_id}: {applied:+d} → {bonus_count}" + (f" (запрошено {requested:+d})" if applied != requested else "")
+        for (_, requested), (user_id, applied, bonus_count) in zip(entries[:BONUS_REPORT_LINES], results)
+    )
+    more = f"\n… и еще {len(results) - BONUS_REPORT_LINES}" if len(results) > BONUS_REPORT_LINES else ""
+    
+    logger.info(f"Bulk bonus batch {batch_key} applied by developer: {len(results)} entries, {users} users")
+    await send_queue.reply(update.message, 
+        f"✅ Пакет применен!\n\n"
+        f"• Строк: {len(results)}\n"
+        f"• Пользователей: {users}\n"
+        f"• Начислено: {added}\n"
+        f"• Списано: {removed}\n\n"
+        f"{lines}{more}"
+    )
     return ConversationHandler.END
 
 # Отмена диалога разработчика
 async def cancel_dev(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("❌ Операция отменена.")
+    await send_queue.reply(update.message, "❌ Операция отменена.")
     return ConversationHandler.END
 
 # Обработка сообщений с учетом лимитов
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    started = time.perf_counter()
+    result = "error"
+    try:
+        result = await process_message(update, context, started)
+    finally:
+        # Для поставленных в очередь ходов задержка замеряется в run_turn
+        if result != "queued":
+            HANDLE_MESSAGE_SECONDS.observe(time.perf_counter() - started, result=result)
+
+async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE, started: float) -> str:
     message = update.message
     user = message.from_user
     chat_id = message.chat_id
-    key = (chat_id, user.id)
+    key = conversation_key(chat_id, user.id)
     
     if not message.text:
-        return
+        return "empty"
     
-    # Улучшенная обработка групповых чатов
-    bot_username = (await context.bot.get_me()).username
-    is_private = message.chat.type == "private"
+    # Сообщения в группах, не адресованные боту, отсекаются фильтром addressed_to_bot
     is_unlimited = chat_id == UNLIMITED_CHAT_ID
-    bot_mention = f"@{bot_username}"
-    
-    # Проверка, является ли сообщение адресованным боту
-    is_reply_to_bot = (
-        message.reply_to_message and 
-        message.reply_to_message.from_user.username == bot_username
-    )
-    is_mention = bot_mention in message.text
-    is_bot_name_in_text = bot_username in message.text.lower()
     
-    # Для групповых чатов реагируем только на:
-    # 1. Ответы на сообщения бота
-    # 2. Сообщения с упоминанием бота (@username)
-    # 3. Сообщения с именем бота в тексте (без @)
-    is_addressed_to_bot = is_reply_to_bot or is_mention or is_bot_name_in_text
-    
-    # В групповых чатах (не приватных) игнорируем сообщения не адресованные боту
-    if not is_private and not is_addressed_to_bot:
-        return
+    # Пока автомат отключения разомкнут, отвечаем сразу и не списываем запрос
+    if not llm_router.available():
+        await send_queue.reply(message, PROVIDER_UNAVAILABLE_TEXT)
+        return "unavailable"
     
     # Проверка лимита сообщений (только для обычных чатов)
     if not is_unlimited:
-        # Проверяем лимит перед увеличением счетчика
-        if not check_message_limit(user.id):
+        # Проверка лимита и списание сообщения - одна атомарная операция хранилища
+        with tracing.span("quota.reserve", user_id=user.id):
+            reserved, quota = await state.reserve_message(user.id)
+        if not reserved:
             logger.warning(f"User {user.full_name} ({user.id}) exceeded daily message limit")
+            LIMIT_DENIALS.inc()
             
-            today = datetime.utcnow().strftime("%Y-%m-%d")
-            base_limit = 35
-            referral_bonus = get_referral_count(user.id) * 3
-            bonus_messages = get_bonus_count(user.id)
-            total_limit = base_limit + referral_bonus + bonus_messages
+            total_limit = quota.total_limit
             
-            await message.reply_text(
+            await send_queue.reply(message, 
                 f"❗️Вы достигли ежедневного лимита на общение с Алисой ({total_limit} сообщений).\n"
                 "Возвращайтесь завтра или продолжите безлимитно ей пользоваться в чате - "
                 "https://t.me/freedom346\n\n"
@@ -501,48 +801,173 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "• Увеличить число дневных запросов через реферальную программу: /ref\n"
                 "• Купить дополнительные запросы: /buy"
             )
-            return
-        
-        # Увеличиваем счетчик сообщений только если лимит не превышен
-        today = datetime.utcnow().strftime("%Y-%m-%d")
-        increment_daily_counter(user.id, today)
+            return "denied"
     
     logger.info(f"Обработка сообщения от {user.full_name} в чате {chat_id}: {message.text}")
     
-    await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
+    # Сообщения, пришедшие пока ход пользователя ждет очереди, сливаются в этот ход
+    # Дата списания хранится вместе с сообщением: возврат идет в тот же день, даже после полуночи
+    charge = None if is_unlimited else (user.id, quota.date)
+    job = llm_scheduler.submit(key, chat_id, message, charge)
+    if job is None:
+        logger.info(f"Сообщение от {user.full_name} в чате {chat_id} объединено с ожидающим ходом")
+        return "merged"
+    
+    # Ответ формируется в отдельной задаче: обновления чата обрабатываются по порядку,
+    # и следующее сообщение должно успеть слиться с ожидающим ходом, а не ждать ответа LLM.
+    # Порядок ходов одного диалога сохраняет планировщик.
+    # Спан хода остается открытым до ответа, поэтому трасса обновления выгружается целиком
+    turn_span = tracing.start_span("llm.turn", lane=chat_id)
+    context.application.create_task(run_turn(context, job, started, turn_span), update=update)
+    return "queued"
+
+async def run_turn(context: ContextTypes.DEFAULT_TYPE, job, started: float, turn_span=tracing.NOOP_SPAN):
+    result = "error"
+    try:
+        # Индикатор набора отправляется в фоне с низшим приоритетом
+        send_queue.typing(context.bot, job.lane)
+        if is_coalescing_chat(job.lane):
+            # Пока ход ждет, в него сливаются сообщения других участников чата
+            await asyncio.sleep(COALESCE_WINDOW)
+        with tracing.use_span(turn_span):
+            async with job:
+                delivery = await respond(context, job)
+            # Доставка в Telegram (лимиты, паузы 429) ждется без слота планировщика,
+            # чтобы медленный чат не занимал общую параллельность LLM
+            if delivery is not None:
+                try:
+                    await delivery
+                except Exception as e:
+                    logger.error(f"Ошибка доставки ответа в чат {job.lane}: {e}")
+                    await refund_turn(job)
+                    return
+        result = "replied"
+    finally:
+        turn_span.set(items=len(job.items), result=result)
+        turn_span.end()
+        HANDLE_MESSAGE_SECONDS.observe(time.perf_counter() - started, result=result)
+
+# Ответ на ход диалога (одно или несколько объединенных сообщений пользователя).
+# Возвращает ожидаемый объект доставки ответа (None, если ответа нет)
+async def respond(context: ContextTypes.DEFAULT_TYPE, job):
+    key = job.key
+    # Отвечаем на последнее сообщение хода
+    message = job.items[-1]
+    user = message.from_user
+    text = "\n".join(item.text for item in job.items)
     
     try:
-        history = user_contexts.get(key, [])
-        user_message_content = f"{user.full_name}: {message.text}"
+        history = await state.get_context(key)
+        summary = await state.get_summary(key)
+        user_message_content = format_turn(job.items)
         user_message = {"role": "user", "content": user_message_content}
         
-        messages = [{"role": "system", "content": PERSONA}]
-        messages.extend(history)
-        messages.append(user_message)
+        # Окно истории подбирается по бюджету токенов, от новых записей к старым
+        messages, dropped = build_prompt(PERSONA, summary, history, user_message)
         
-        loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(None, query_chat_voapi, messages)
-        cleaned_response = clean_response(response)
+        # Первые сообщения без истории можно отдать из кэша ответов
+        cache_key = None
+        cached_response = None
+        if RESPONSE_CACHE_ENABLED and not history and not summary and len(job.items) == 1:
+            cache_key = response_cache.make_key(text, llm_router.model_key, PERSONA_HASH)
+            cached_response = response_cache.get(cache_key, user.full_name, user.first_name)
         
-        if not cleaned_response.strip():
-            cleaned_response = "Я обдумываю твой вопрос... Попробуй спросить по-другому."
-        
-        history.append(user_message)
-        history.append({"role": "assistant", "content": cleaned_response})
+        if cached_response:
+            cleaned_response = cached_response
+            delivery = send_queue.reply(message, cleaned_response)
+        elif LLM_STREAMING:
+            cleaned_response, delivery = await stream_reply(message, messages)
+        else:
+            response = await llm_router.chat(messages)
+            cleaned_response = clean_response(response)
+            
+            if not cleaned_response.strip():
+                CLEANED_RESPONSES.inc(result="empty")
+                cleaned_response = EMPTY_RESPONSE_TEXT
+            else:
+                CLEANED_RESPONSES.inc(result="ok")
+            
+            # Отправляем ответ без форматирования Markdown
+            delivery = send_queue.reply(message, cleaned_response)
         
-        if len(history) > 10:
-            history = history[-10:]
+        if cache_key and not cached_response and cleaned_response != EMPTY_RESPONSE_TEXT:
+            response_cache.put(cache_key, cleaned_response, user.full_name, user.first_name)
         
-        user_contexts[key] = history
+        turn = [user_message, {"role": "assistant", "content": cleaned_response}]
         
-        # Отправляем ответ без форматирования Markdown
-        await message.reply_text(cleaned_response)
+        # Записи, выпавшие из окна, сворачиваются в резюме в фоне
+        folded, window = split_history(history + turn, dropped)
+        async with context_lock(key):
+            # Сворачивание могло уже убрать из истории начало: дописываем к актуальной
+            history = await state.get_context(key)
+            await state.set_context(key, cap_history(history + turn))
+        if fold_due(folded):
+            # Сворачивание не относится к трассе обновления и не входит в его задержку
+            with tracing.use_span(None):
+                context.application.create_task(fold_into_summary(key, len(window)))
+        return delivery
             
+    except ProviderUnavailable as e:
+        logger.warning(f"LLM provider unavailable: {e}")
+        await refund_turn(job)
+        send_queue.reply(message, PROVIDER_UNAVAILABLE_TEXT)
     except Exception as e:
         logger.error(f"Ошибка обработки сообщения: {e}")
-        await message.reply_text("Что-то пошло не так. Попробуйте еще раз.")
+        await refund_turn(job)
+        send_queue.reply(message, "Что-то пошло не так. Попробуйте еще раз.")
+    return None
+
+# Возврат списанных за ход сообщений, если ответ не был получен
+async def refund_turn(job):
+    # В объединенном ходе сообщения могли списываться у разных участников и в разные дни
+    counts = {}
+    for charge in job.charges:
+        counts[charge] = counts.get(charge, 0) + 1
+    for (user_id, date), count in counts.items():
+        await state.refund_message(user_id, date, count)
+
+# Ожидание доступности провайдера LLM с экспоненциальной задержкой
+async def wait_for_provider(timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    delay = 0.5
+    while True:
+        if await llm_router.ping():
+            readiness.set("llm_provider")
+            logger.info("LLM provider is reachable")
+            return True
+        if time.monotonic() + delay > deadline:
+            return False
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 15)
+
+# Ожидание, пока предыдущий экземпляр бота освободит getUpdates
+async def wait_for_polling_slot(bot):
+    await bot.delete_webhook(drop_pending_updates=True)
+    delay = 1
+    while True:
+        try:
+            await bot.get_updates(offset=-1, limit=1, timeout=0)
+            readiness.set("updates")
+            return
+        except Conflict:
+            logger.warning(f"Another bot instance is still polling, retrying in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+
+# Обработчик ошибок приложения
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if isinstance(context.error, Conflict):
+        logger.warning("getUpdates conflict: another bot instance is polling")
+        return
+    logger.error(f"Unhandled error while processing update: {context.error}", exc_info=context.error)
 
 async def post_init(application: Application) -> None:
+    # Токен уже проверен вызовом get_me в Application.initialize
+    readiness.set("telegram")
+    readiness.set("database", await state.check())
+    if state.local:
+        maintenance_worker.start()
+    
     commands = [
         BotCommand("start", "Начало работы с ботом"),
         BotCommand("info", "Информация о боте и правила использования"),
@@ -552,25 +977,156 @@ async def post_init(application: Application) -> None:
         BotCommand("buy", "Купить дополнительные запросы")
     ]
     await application.bot.set_my_commands(commands)
+    
+    # Имя бота определяется один раз при старте (get_me уже выполнен в initialize)
+    addressed_to_bot.set_username(application.bot.username)
+    logger.info(f"Bot identity resolved: @{application.bot.username}")
     logger.info("Меню команд бота установлено")
+    
+    if not await wait_for_provider(STARTUP_PROVIDER_TIMEOUT):
+        # Запускаемся без провайдера: готовность выставится, когда он ответит
+        logger.warning("LLM provider is not reachable yet, continuing startup")
+        application.create_task(wait_for_provider(float("inf")))
+    
+    # В режиме polling дожидаемся, пока старый экземпляр перестанет читать обновления
+    if BOT_MODE != "webhook":
+        await wait_for_polling_slot(application.bot)
 
-def main():
-    if not TOKEN:
-        logger.error("TG_TOKEN environment variable is missing!")
-        return
-    if not VOAPI_API_KEY:
-        logger.error("VOAPI_API_KEY environment variable is missing!")
-        return
+async def post_stop(application: Application) -> None:
+    # Отправляем оставшиеся в очереди ответы, пока клиент Telegram еще открыт
+    await send_queue.drain()
 
-    # Запуск HTTP-сервера
-    port = int(os.getenv('PORT', 8080))
-    http_thread = threading.Thread(target=run_http_server, args=(port,), daemon=True)
-    http_thread.start()
+async def post_shutdown(application: Application) -> None:
+    readiness.reset()
+    maintenance_worker.stop()
+    # Закрываем пул соединений с провайдером LLM
+    await llm_router.aclose()
+    await state.close()
+    trace_exporter.stop()
 
-    logger.info("Ожидание 45 секунд перед запуском бота...")
-    time.sleep(45)
+# Работа в режиме вебхука: обновления принимает HTTP-сервер на порту проверок
+async def run_webhook(application: Application):
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    def enqueue_update(data: dict):
+        # Вызывается из потоков waitress: передаем обновление в event loop бота
+        update = Update.de_json(data, application.bot)
+        future = asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop)
+        future.result(timeout=10)
+    
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        await application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        set_update_handler(enqueue_update, WEBHOOK_SECRET)
+        readiness.set("updates")
+        logger.info(f"Webhook установлен: {webhook_url}")
+        
+        await application.start()
+        await stop_event.wait()
+        
+        set_update_handler(None)
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
-    application = Application.builder().token(TOKEN).post_init(post_init).build()
+# Рабочий процесс: обрабатывает обновления своей доли чатов из очереди главного процесса
+def run_worker(index: int, updates):
+    # Остановкой управляет главный процесс (через None в очереди)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logger.info(f"Bot worker {index} started (pid {os.getpid()})")
+    asyncio.run(run_shard(build_application(), updates))
+
+async def run_shard(application: Application, updates):
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+        await application.post_stop(application)
+        await application.post_shutdown(application)
+
+# Режим вебхука с несколькими процессами: главный процесс принимает обновления
+# и раздает их рабочим процессам по chat_id (порядок внутри чата сохраняется)
+async def run_sharded_webhook(workers: int):
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    spawn = multiprocessing.get_context("spawn")
+    queues = [spawn.Queue() for _ in range(workers)]
+    processes = [
+        spawn.Process(target=run_worker, args=(index, queue), name=f"bot-worker-{index}")
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    
+    def enqueue_update(data: dict):
+        # Вызывается из потоков waitress
+        queues[shard_index(data, workers)].put(data)
+    
+    async with Bot(TOKEN) as bot:
+        readiness.set("telegram")
+        readiness.set("database", await state.check())
+        provider_task = asyncio.create_task(wait_for_provider(float("inf")))
+        
+        webhook_url = f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}"
+        await bot.set_webhook(
+            url=webhook_url,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        set_update_handler(enqueue_update, WEBHOOK_SECRET)
+        logger.info(f"Webhook установлен: {webhook_url}, рабочих процессов: {workers}")
+        
+        # Готовность пропадает, если какой-либо рабочий процесс завершился
+        while not stop_event.is_set():
+            readiness.set("updates", all(process.is_alive() for process in processes))
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+        
+        set_update_handler(None)
+        readiness.reset()
+        provider_task.cancel()
+    
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        await loop.run_in_executor(None, process.join)
+    await llm_router.aclose()
+    await state.close()
+
+def build_application() -> Application:
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(update_processor)
+        .build()
+    )
     
     # Регистрация обработчиков команд
     application.add_handler(CommandHandler("start", start))
@@ -584,7 +1140,10 @@ def main():
     dev_handler = ConversationHandler(
         entry_points=[CommandHandler("dev", dev)],
         states={
-            SELECT_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_user)],
+            SELECT_USER: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, select_user),
+                MessageHandler(filters.Document.ALL, bulk_bonus_upload)
+            ],
             SELECT_ACTION: [CallbackQueryHandler(select_action)],
             INPUT_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, input_amount)]
         },
@@ -592,11 +1151,50 @@ def main():
         allow_reentry=True
     )
     application.add_handler(dev_handler)
+    application.add_error_handler(error_handler)
     
     # Основной обработчик сообщений
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
+        MessageHandler(filters.TEXT & ~filters.COMMAND & addressed_to_bot, handle_message)
     )
+    return application
+
+def main():
+    if not TOKEN:
+        logger.error("TG_TOKEN environment variable is missing!")
+        return
+    if not all(backend.client.api_key for backend in llm_router.backends):
+        logger.error("VOAPI_API_KEY (or api key of an LLM backend) is missing!")
+        return
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL environment variable is missing for webhook mode!")
+        return
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        # Секрет должен быть общим: иначе каждый экземпляр за балансировщиком
+        # перезаписывает вебхук своим и остальные отклоняют обновления
+        logger.error("WEBHOOK_SECRET environment variable is missing for webhook mode!")
+        return
+    if BOT_WORKERS > 1 and (BOT_MODE != "webhook" or state.local):
+        # Квоты и истории должны быть общими для всех процессов
+        logger.error("BOT_WORKERS > 1 requires BOT_MODE=webhook and STATE_BACKEND=redis!")
+        return
+
+    # Запуск HTTP-сервера (проверки работоспособности и вебхук)
+    port = int(os.getenv('PORT', 8080))
+    http_thread = threading.Thread(target=run_http_server, args=(port,), daemon=True)
+    http_thread.start()
+
+    if BOT_WORKERS > 1:
+        logger.info(f"Запуск бота в режиме webhook с {BOT_WORKERS} рабочими процессами...")
+        asyncio.run(run_sharded_webhook(BOT_WORKERS))
+        return
+    
+    application = build_application()
+    
+    if BOT_MODE == "webhook":
+        logger.info("Запуск бота в режиме webhook...")
+        asyncio.run(run_webhook(application))
+        return
     
     logger.info("Запуск бота в режиме polling...")
     
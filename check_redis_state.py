@@ -0,0 +1,110 @@
+"""
+Проверка RedisStateBackend (Lua-скрипты квот, рефералов и бонусов) на
+локальном сервере Redis или в памяти через fakeredis.
+
+    python check_redis_state.py            # сервер из REDIS_URL (данные пишутся под отдельным префиксом)
+    python check_redis_state.py --fake     # fakeredis[lua], сервер не нужен
+
+При ошибке процесс завершается с кодом 1.
+"""
+import sys
+import uuid
+import asyncio
+import logging
+import argparse
+
+from quota import BASE_LIMIT, REFERRAL_BONUS
+from state import RedisStateBackend, REDIS_URL
+
+failures = []
+
+def expect(condition: bool, message: str):
+    print(f"{'ok  ' if condition else 'FAIL'} {message}")
+    if not condition:
+        failures.append(message)
+
+async def check_quota(backend: RedisStateBackend):
+    user_id = 1
+    # Параллельные резервирования не превышают лимит
+    results = await asyncio.gather(*(backend.reserve_message(user_id) for _ in range(BASE_LIMIT + 15)))
+    allowed = sum(1 for reserved, _ in results if reserved)
+    expect(allowed == BASE_LIMIT, f"quota cap holds under concurrency: {allowed} of {BASE_LIMIT}")
+    
+    quota = await backend.get_quota(user_id)
+    expect(quota.used == BASE_LIMIT and quota.exhausted, f"used counter is {quota.used}")
+    
+    # Возврат освобождает ровно одно сообщение
+    await backend.refund_message(user_id, quota.date)
+    first, _ = await backend.reserve_message(user_id)
+    second, _ = await backend.reserve_message(user_id)
+    expect(first and not second, "refund frees exactly one message")
+    
+    # Возврат не уводит счетчик в минус
+    await backend.refund_message(2, quota.date, 5)
+    expect((await backend.get_quota(2)).used == 0, "refund does not go below zero")
+
+async def check_referrals(backend: RedisStateBackend):
+    referrer_id, invited_id = 10, 11
+    added = await backend.add_referral(invited_id, referrer_id)
+    repeated = await backend.add_referral(invited_id, 12)
+    expect(added and not repeated, "referral is added once")
+    expect(await backend.get_referrer_id(invited_id) == referrer_id, "first referrer is kept")
+    
+    quota = await backend.get_quota(referrer_id)
+    expect(quota.referrals == 1, f"referral count is {quota.referrals}")
+    expect(quota.total_limit == BASE_LIMIT + REFERRAL_BONUS, "referral bonus is added to the limit")
+
+async def check_bonus_batches(backend: RedisStateBackend):
+    user_id = 20
+    results = await backend.apply_bonus_batch("check:1", [(user_id, 5), (21, 3)])
+    expect(results == [(user_id, 5, 5), (21, 3, 3)], f"batch applied: {results}")
+    
+    # Списание ограничено балансом: в результат попадает фактическое изменение
+    results = await backend.apply_bonus_batch("check:2", [(user_id, -10)])
+    expect(results == [(user_id, -5, 0)], f"debit is clamped at zero: {results}")
+    
+    repeated = await backend.apply_bonus_batch("check:1", [(user_id, 5)])
+    expect(repeated is None, "batch with the same key is applied once")
+    expect((await backend.get_quota(user_id)).bonus == 0, "repeated batch leaves the balance unchanged")
+    
+    ledger = await backend.client.llen(backend._key("bonus_ledger"))
+    expect(ledger == 3, f"ledger has {ledger} entries")
+
+async def check_contexts(backend: RedisStateBackend):
+    key = (-100, 30)
+    history = [{"role": "user", "content": "Имя: привет"}]
+    await backend.set_context(key, history, "резюме")
+    expect(await backend.get_context(key) == history, "history round-trips")
+    expect(await backend.get_summary(key) == "резюме", "summary round-trips")
+    expect(await backend.has_context(30), "user has a context")
+    expect(await backend.delete_context(key), "context is deleted")
+    expect(not await backend.has_context(30), "user has no context after delete")
+
+async def main(fake: bool):
+    if fake:
+        import fakeredis
+        backend = RedisStateBackend(client=fakeredis.FakeAsyncRedis(decode_responses=True))
+    else:
+        # Отдельный префикс: проверка не затрагивает данные бота
+        backend = RedisStateBackend(REDIS_URL, prefix=f"check-{uuid.uuid4().hex[:8]}:")
+    try:
+        for check in (check_quota, check_referrals, check_bonus_batches, check_contexts):
+            await check(backend)
+        if not fake:
+            keys = [key async for key in backend.client.scan_iter(backend.prefix + "*")]
+            if keys:
+                await backend.client.delete(*keys)
+    finally:
+        await backend.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RedisStateBackend checks")
+    parser.add_argument("--fake", action="store_true", help="fakeredis вместо сервера из REDIS_URL")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(main(args.fake))
+    if failures:
+        print(f"{len(failures)} check(s) failed")
+        sys.exit(1)
+    print("All checks passed")
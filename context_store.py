@@ -0,0 +1,233 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Ограничения хранилища историй диалогов
+CONTEXT_MAX_ENTRIES = int(os.getenv("CONTEXT_MAX_ENTRIES", 5000))
+CONTEXT_IDLE_TTL = float(os.getenv("CONTEXT_IDLE_TTL", 3600))
+CONTEXT_MEMORY_BUDGET = int(os.getenv("CONTEXT_MEMORY_BUDGET", 32 * 1024 * 1024))
+
+# Примерные накладные расходы на одно сообщение в истории (dict + строки)
+MESSAGE_OVERHEAD = 200
+
+def estimate_history_size(history: list) -> int:
+    """Грубая оценка памяти, занимаемой историей (в байтах)"""
+    return sum(MESSAGE_OVERHEAD + 2 * len(item.get("content", "")) for item in history)
+
+class _Entry:
+    __slots__ = ("history", "summary", "size", "last_access")
+
+    def __init__(self, history: list, summary: str = ""):
+        self.history = history
+        self.summary = summary
+        self.size = estimate_history_size(history) + 2 * len(summary)
+        self.last_access = time.monotonic()
+
+class ContextStore:
+    """
+    Хранилище историй диалогов по ключу (chat_id, user_id).
+    В памяти держатся недавно активные диалоги (LRU + TTL простоя + бюджет памяти),
+    вытесненные истории сохраняются в SQLite и подгружаются при следующем сообщении.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = CONTEXT_MAX_ENTRIES,
+        idle_ttl: float = CONTEXT_IDLE_TTL,
+        memory_budget: int = CONTEXT_MEMORY_BUDGET
+    ):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+        # Вторичный индекс: user_id -> chat_id, где у пользователя есть история в памяти
+        self._by_user = {}
+        # Вытесненные записи, сохранение которых в БД еще не завершено: до этого
+        # момента они читаются отсюда, а не из БД (где их еще нет или они старые)
+        self._spilling = {}
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def _index_add(self, key):
+        chat_id, user_id = key
+        self._by_user.setdefault(user_id, set()).add(chat_id)
+
+    def _index_remove(self, key):
+        chat_id, user_id = key
+        chats = self._by_user.get(user_id)
+        if chats is not None:
+            chats.discard(chat_id)
+            if not chats:
+                del self._by_user[user_id]
+
+    def _put(self, key, entry: _Entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old.size
+        self._entries[key] = entry
+        self._size += entry.size
+        self._index_add(key)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+            self._index_remove(key)
+        return entry
+
+    def _collect_evictions(self) -> list:
+        """Выбор вытесняемых записей: простаивающие, сверх лимита и сверх бюджета"""
+        evicted = []
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            over_limit = len(self._entries) > self.max_entries or self._size > self.memory_budget
+            if not over_limit and now - entry.last_access < self.idle_ttl:
+                break
+            self._pop(key)
+            self._spilling[key] = entry
+            evicted.append((key, entry))
+        return evicted
+
+    def _spill(self, evicted: list):
+        """Сохранение вытесненных записей; после фиксации они перестают читаться из памяти"""
+        if not evicted:
+            return
+        try:
+            database.save_contexts([(key[0], key[1], entry.history, entry.summary) for key, entry in evicted])
+        finally:
+            with self._lock:
+                for key, entry in evicted:
+                    if self._spilling.get(key) is entry:
+                        del self._spilling[key]
+
+    def _cached(self, key):
+        """Запись из памяти (None, если ее там нет)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Запись еще сохраняется после вытеснения - возвращаем ее в память
+                entry = self._spilling.pop(key, None)
+                if entry is None:
+                    return None
+                self._put(key, entry)
+            entry.last_access = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry
+
+    def _load(self, key):
+        """Запись из памяти или из БД (None, если диалога нет)"""
+        entry = self._cached(key)
+        if entry is not None:
+            return entry
+
+        stored = database.load_context(*key)
+        if stored is None:
+            return None
+
+        with self._lock:
+            # Запись могла появиться, пока шла загрузка
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(*stored)
+                self._put(key, entry)
+            evicted = self._collect_evictions()
+        self._spill(evicted)
+        return entry
+
+    def get(self, key) -> list:
+        """История диалога (копия); при необходимости подгружается из БД"""
+        entry = self._load(key)
+        return list(entry.history) if entry is not None else []
+
+    def get_summary(self, key) -> str:
+        """Краткое содержание реплик, выпавших из окна истории"""
+        entry = self._load(key)
+        return entry.summary if entry is not None else ""
+
+    def _set(self, key, history: list, summary: str = None) -> list:
+        with self._lock:
+            if summary is None:
+                old = self._entries.get(key) or self._spilling.get(key)
+                summary = old.summary if old is not None else ""
+            self._put(key, _Entry(list(history), summary))
+            return self._collect_evictions()
+
+    def set(self, key, history: list, summary: str = None):
+        evicted = self._set(key, history, summary)
+        if evicted:
+            self._spill(evicted)
+            logger.info(f"Spilled {len(evicted)} conversation contexts to database")
+
+    def delete(self, key) -> bool:
+        """Удаление истории из памяти и БД; True, если история была"""
+        with self._lock:
+            in_memory = self._pop(key) is not None
+            in_memory = self._spilling.pop(key, None) is not None or in_memory
+        in_database = database.delete_context(*key)
+        return in_memory or in_database
+
+    def _has_user_in_memory(self, user_id: int) -> bool:
+        with self._lock:
+            return user_id in self._by_user or any(key[1] == user_id for key in self._spilling)
+
+    def has_user(self, user_id: int) -> bool:
+        if self._has_user_in_memory(user_id):
+            return True
+        return database.has_context(user_id)
+
+    def evict_idle(self):
+        """Вытеснение простаивающих историй (можно вызывать периодически)"""
+        with self._lock:
+            evicted = self._collect_evictions()
+        self._spill(evicted)
+
+    def spill_all(self):
+        """Сохранение всех историй в БД (при остановке бота)"""
+        with self._lock:
+            items = [
+                (chat_id, user_id, entry.history, entry.summary)
+                for (chat_id, user_id), entry in self._entries.items()
+            ]
+        database.save_contexts(items)
+        logger.info(f"Saved {len(items)} conversation contexts to database")
+
+    # Асинхронные версии для обработчиков: записи в памяти обслуживаются
+    # сразу, загрузка и сохранение в БД выполняются в потоках БД
+
+    async def aget(self, key) -> list:
+        entry = self._cached(key)
+        if entry is not None:
+            return list(entry.history)
+        return await database.run_async(self.get, key)
+
+    async def aget_summary(self, key) -> str:
+        entry = self._cached(key)
+        if entry is not None:
+            return entry.summary
+        return await database.run_async(self.get_summary, key)
+
+    async def aset(self, key, history: list, summary: str = None):
+        evicted = self._set(key, history, summary)
+        if evicted:
+            await database.run_async(self._spill, evicted)
+            logger.info(f"Spilled {len(evicted)} conversation contexts to database")
+
+    async def adelete(self, key) -> bool:
+        return await database.run_async(self.delete, key)
+
+    async def ahas_user(self, user_id: int) -> bool:
+        if self._has_user_in_memory(user_id):
+            return True
+        return await database.run_async(database.has_context, user_id)
+
+    def __len__(self):
+        return len(self._entries)
+
+context_store = ContextStore()
@@ -1,7 +1,15 @@
 import sqlite3
 import os
 import logging
-from datetime import datetime
+import threading
+import atexit
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from metrics import Gauge, Histogram, FAST_BUCKETS
+import tracing
 
 # Настройка логгирования
 logging.basicConfig(
@@ -10,12 +18,133 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-DB_FILE = "bot_data.db"
+DB_FILE = os.getenv("DB_FILE", "bot_data.db")
+
+# Параметры долгоживущих соединений
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", 5))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 8192))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 64 * 1024 * 1024))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 128))
+
+# Число потоков, выполняющих запросы к БД для асинхронных обработчиков
+DB_WORKERS = int(os.getenv("DB_WORKERS", 2))
+
+# Отложенная запись счетчиков сообщений (write-behind)
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0") == "1"
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", 2))
+DB_FLUSH_THRESHOLD = int(os.getenv("DB_FLUSH_THRESHOLD", 500))
+
+# Длительность функций слоя БД
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds",
+    "Duration of database.py functions",
+    ("function",),
+    buckets=FAST_BUCKETS
+)
+
+def _timed(func):
+    return DB_QUERY_SECONDS.timed(function=func.__name__)(func)
+
+# Одно соединение на поток: sqlite3.Connection нельзя безопасно делить между потоками
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+# Поколение соединений: после close_connections потоки открывают новые
+_generation = 0
+
+def _open_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False
+    )
+    # Для новой БД: освобождение страниц по частям (PRAGMA incremental_vacuum)
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Получение долгоживущего соединения текущего потока"""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "generation", None) != _generation:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+def close_connections():
+    """Закрытие всех открытых соединений (при остановке бота)"""
+    # Сначала сбрасываем накопленные счетчики
+    counter_buffer.stop()
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"Error closing database connection: {e}")
+        _connections.clear()
+    _local.__dict__.pop("conn", None)
+
+# Асинхронный доступ: запросы выполняются в выделенных потоках БД,
+# чтобы фиксация транзакций не блокировала event loop
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+_pending_calls = 0
+_pending_lock = threading.Lock()
+
+def pending_db_calls() -> int:
+    """Число запросов в очереди и в работе у потоков БД"""
+    return _pending_calls
+
+Gauge("db_queue_depth", "Database calls queued or running in DB worker threads", callback=pending_db_calls)
+
+async def run_async(func, *args, **kwargs):
+    """Выполнение синхронной функции слоя БД в потоке БД"""
+    global _pending_calls
+    with _pending_lock:
+        _pending_calls += 1
+    span = tracing.start_span(f"db.{getattr(func, '__name__', 'call')}")
+    
+    def call():
+        # Время ожидания свободного потока БД
+        span.set(queue_wait_ms=round(span.elapsed_ms(), 2))
+        return func(*args, **kwargs)
+    
+    try:
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(_executor, call)
+    except BaseException as e:
+        span.end(e)
+        raise
+    else:
+        span.end()
+        return result
+    finally:
+        with _pending_lock:
+            _pending_calls -= 1
+
+def check_database() -> bool:
+    """Проверка доступности БД и наличия таблиц"""
+    try:
+        with get_connection() as conn:
+            conn.execute("SELECT 1 FROM daily_counters LIMIT 1").fetchall()
+        return True
+    except Exception as e:
+        logger.error(f"Database check failed: {e}")
+        return False
 
 def init_db():
     """Инициализация базы данных и создание таблиц"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             # Таблица рефералов
@@ -26,6 +155,28 @@ def init_db():
                     created_at TEXT NOT NULL
                 )
             ''')
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id)"
+            )
+            
+            # Число приглашенных по каждому рефереру (обновляется вместе с referrals)
+            backfill_referrals = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'referral_counts'"
+            ).fetchone() is None
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS referral_counts (
+                    referrer_id INTEGER PRIMARY KEY,
+                    count INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            if backfill_referrals:
+                # Миграция: счетчики для уже существующих рефералов
+                cursor.execute('''
+                    INSERT OR REPLACE INTO referral_counts (referrer_id, count)
+                    SELECT referrer_id, COUNT(*) FROM referrals GROUP BY referrer_id
+                ''')
+                if cursor.rowcount > 0:
+                    logger.info(f"Backfilled referral counts for {cursor.rowcount} referrers")
             
             # Таблица бонусных сообщений
             cursor.execute('''
@@ -36,6 +187,36 @@ def init_db():
                 )
             ''')
             
+            # Журнал начислений бонусов (только добавление) и примененные пакеты
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bonus_batches (
+                    batch_key TEXT PRIMARY KEY,
+                    source TEXT NOT NULL DEFAULT '',
+                    entries INTEGER NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bonus_ledger (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    batch_key TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    delta INTEGER NOT NULL,
+                    requested INTEGER NOT NULL DEFAULT 0,
+                    bonus_count INTEGER NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_bonus_ledger_user ON bonus_ledger (user_id)"
+            )
+            
+            # Миграция: в delta теперь фактическое изменение, запрошенное - в requested
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(bonus_ledger)")]
+            if "requested" not in columns:
+                cursor.execute("ALTER TABLE bonus_ledger ADD COLUMN requested INTEGER NOT NULL DEFAULT 0")
+                cursor.execute("UPDATE bonus_ledger SET requested = delta")
+            
             # Таблица счетчиков сообщений (для ежедневных лимитов)
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS daily_counters (
@@ -45,30 +226,75 @@ def init_db():
                     PRIMARY KEY (user_id, date)
                 )
             ''')
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_daily_counters_date ON daily_counters (date)"
+            )
+            
+            # Агрегированная статистика использования по дням
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_usage (
+                    date TEXT PRIMARY KEY,
+                    users INTEGER NOT NULL DEFAULT 0,
+                    messages INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            # Таблица вытесненных из памяти историй диалогов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS conversation_contexts (
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    history TEXT NOT NULL,
+                    summary TEXT NOT NULL DEFAULT '',
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (chat_id, user_id)
+                )
+            ''')
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idx_conversation_contexts_user ON conversation_contexts (user_id)"
+            )
+            
+            # Миграция: краткое содержание старых реплик диалога
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(conversation_contexts)")]
+            if "summary" not in columns:
+                cursor.execute("ALTER TABLE conversation_contexts ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
             
             conn.commit()
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
 
-def add_referral(invited_id: int, referrer_id: int):
-    """Добавление реферальной связи"""
+@_timed
+def add_referral(invited_id: int, referrer_id: int) -> bool:
+    """Добавление реферальной связи; True, если связь новая"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT OR IGNORE INTO referrals (invited_id, referrer_id, created_at) VALUES (?, ?, ?)",
                 (invited_id, referrer_id, datetime.utcnow().isoformat())
             )
+            added = cursor.rowcount == 1
+            if added:
+                # Счетчик обновляется в той же транзакции, что и связь
+                cursor.execute(
+                    "INSERT INTO referral_counts (referrer_id, count) VALUES (?, 1) "
+                    "ON CONFLICT(referrer_id) DO UPDATE SET count = count + 1",
+                    (referrer_id,)
+                )
             conn.commit()
-        logger.info(f"Referral added: invited_id={invited_id}, referrer_id={referrer_id}")
+        if added:
+            logger.info(f"Referral added: invited_id={invited_id}, referrer_id={referrer_id}")
+        return added
     except Exception as e:
         logger.error(f"Error adding referral: {e}")
+        return False
 
+@_timed
 def get_referrer_id(invited_id: int) -> int:
     """Получение ID реферера для пользователя"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT referrer_id FROM referrals WHERE invited_id = ?",
@@ -80,13 +306,14 @@ def get_referrer_id(invited_id: int) -> int:
         logger.error(f"Error getting referrer ID: {e}")
         return None
 
+@_timed
 def get_referral_count(referrer_id: int) -> int:
     """Получение количества рефералов для пользователя"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?",
+                "SELECT count FROM referral_counts WHERE referrer_id = ?",
                 (referrer_id,)
             )
             result = cursor.fetchone()
@@ -95,10 +322,11 @@ def get_referral_count(referrer_id: int) -> int:
         logger.error(f"Error getting referral count: {e}")
         return 0
 
+@_timed
 def set_bonus_count(user_id: int, bonus_count: int):
     """Установка количества бонусных сообщений для пользователя"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 '''INSERT OR REPLACE INTO bonus_messages 
@@ -111,10 +339,11 @@ def set_bonus_count(user_id: int, bonus_count: int):
     except Exception as e:
         logger.error(f"Error setting bonus count: {e}")
 
+@_timed
 def get_bonus_count(user_id: int) -> int:
     """Получение количества бонусных сообщений для пользователя"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT bonus_count FROM bonus_messages WHERE user_id = ?",
@@ -126,53 +355,322 @@ def get_bonus_count(user_id: int) -> int:
         logger.error(f"Error getting bonus count: {e}")
         return 0
 
-def increment_daily_counter(user_id: int, date: str):
-    """Увеличение счетчика сообщений для пользователя на указанную дату"""
+@_timed
+def apply_bonus_batch(batch_key: str, entries: list, source: str = ""):
+    """
+    Атомарное изменение бонусов по списку (user_id, delta) одной транзакцией
+    с записью в журнал. Баланс не уходит в минус, поэтому в журнал и в результат
+    попадает фактическое изменение. Возвращает список (user_id, applied, bonus_count)
+    либо None, если пакет с таким ключом уже был применен. Ошибки БД пробрасываются.
+    """
+    now = datetime.utcnow().isoformat()
+    results = []
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            # Первая запись открывает транзакцию: балансы ниже читаются под блокировкой записи
+            cursor.execute(
+                "INSERT OR IGNORE INTO bonus_batches (batch_key, source, entries, created_at) VALUES (?, ?, ?, ?)",
+                (batch_key, source, len(entries), now)
+            )
+            if cursor.rowcount == 0:
+                conn.rollback()
+                logger.info(f"Bonus batch {batch_key} already applied, skipping")
+                return None
+            for user_id, delta in entries:
+                row = cursor.execute(
+                    "SELECT bonus_count FROM bonus_messages WHERE user_id = ?",
+                    (user_id,)
+                ).fetchone()
+                old = row[0] if row else 0
+                bonus_count = max(old + delta, 0)
+                cursor.execute(
+                    '''INSERT INTO bonus_messages (user_id, bonus_count, updated_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        bonus_count = excluded.bonus_count,
+                        updated_at = excluded.updated_at''',
+                    (user_id, bonus_count, now)
+                )
+                applied = bonus_count - old
+                cursor.execute(
+                    '''INSERT INTO bonus_ledger (batch_key, user_id, delta, requested, bonus_count, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?)''',
+                    (batch_key, user_id, applied, delta, bonus_count, now)
+                )
+                results.append((user_id, applied, bonus_count))
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error applying bonus batch {batch_key}: {e}")
+        raise
+    logger.info(f"Bonus batch {batch_key} applied: {len(results)} entries")
+    return results
+
+class CounterWriteBuffer:
+    """
+    Накопление приращений daily_counters в памяти по (user_id, date)
+    и их запись одной транзакцией по интервалу или порогу размера.
+    """
+
+    def __init__(self, interval: float = DB_FLUSH_INTERVAL, threshold: int = DB_FLUSH_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self._pending = {}
+        # Приращения, которые пишутся прямо сейчас, остаются видимыми для чтения
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="counter-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def add(self, user_id: int, date: str, delta: int = 1):
+        with self._lock:
+            key = (user_id, date)
+            self._pending[key] = self._pending.get(key, 0) + delta
+            size = len(self._pending)
+            self._ensure_started()
+        if size >= self.threshold:
+            self._wake.set()
+
+    @property
+    def read_lock(self) -> threading.Lock:
+        """
+        Замок для чтения счетчика из БД вместе с pending(): пока он взят, запись
+        не фиксируется, и уже записанные приращения не учитываются дважды
+        """
+        return self._flush_lock
+
+    def pending(self, user_id: int, date: str) -> int:
+        """Еще не записанные в БД приращения"""
+        key = (user_id, date)
+        with self._lock:
+            return self._pending.get(key, 0) + self._flushing.get(key, 0)
+
+    def flush(self):
+        """Запись накопленных приращений одной транзакцией"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._flushing, self._pending = self._pending, {}
+                batch = [(user_id, date, delta, delta) for (user_id, date), delta in self._flushing.items()]
+            try:
+                with get_connection() as conn:
+                    conn.executemany(
+                        '''INSERT INTO daily_counters (user_id, date, count)
+                        VALUES (?, ?, MAX(?, 0))
+                        ON CONFLICT(user_id, date) DO UPDATE SET count = MAX(count + ?, 0)''',
+                        batch
+                    )
+                with self._lock:
+                    self._flushing = {}
+            except Exception as e:
+                logger.error(f"Error flushing daily counters: {e}")
+                # Возвращаем приращения в очередь для следующей попытки
+                with self._lock:
+                    for key, delta in self._flushing.items():
+                        self._pending[key] = self._pending.get(key, 0) + delta
+                    self._flushing = {}
+
+    def stop(self):
+        """Остановка фонового потока с финальной записью"""
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+counter_buffer = CounterWriteBuffer()
+atexit.register(counter_buffer.stop)
+
+@_timed
+def increment_daily_counter(user_id: int, date: str, delta: int = 1):
+    """Увеличение счетчика сообщений для пользователя на указанную дату (delta < 0 - возврат)"""
+    if DB_WRITE_BEHIND:
+        counter_buffer.add(user_id, date, delta)
+        return
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             # Увеличиваем счетчик или создаем новую запись
             cursor.execute(
                 '''INSERT INTO daily_counters (user_id, date, count)
-                VALUES (?, ?, 1)
-                ON CONFLICT(user_id, date) DO UPDATE SET count = count + 1''',
-                (user_id, date)
+                VALUES (?, ?, MAX(?, 0))
+                ON CONFLICT(user_id, date) DO UPDATE SET count = MAX(count + ?, 0)''',
+                (user_id, date, delta, delta)
             )
             conn.commit()
     except Exception as e:
         logger.error(f"Error incrementing daily counter: {e}")
 
+@_timed
 def get_daily_counter(user_id: int, date: str) -> int:
     """Получение счетчика сообщений для пользователя на указанную дату"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with counter_buffer.read_lock, get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT count FROM daily_counters WHERE user_id = ? AND date = ?",
                 (user_id, date)
             )
             result = cursor.fetchone()
-            return result[0] if result else 0
+            return max(0, (result[0] if result else 0) + counter_buffer.pending(user_id, date))
     except Exception as e:
         logger.error(f"Error getting daily counter: {e}")
         return 0
 
-def cleanup_old_counters():
-    """Очистка устаревших счетчиков сообщений (старше 1 дня)"""
+@_timed
+def cleanup_old_counters(batch_size: int = 1000) -> int:
+    """
+    Очистка устаревших счетчиков сообщений (старше 1 дня) одной порцией.
+    Удаляемые строки в той же транзакции сворачиваются в daily_usage.
+    Возвращает число удаленных строк (0 - очищать больше нечего).
+    """
     try:
         today = datetime.utcnow().date()
         cutoff_date = (today - timedelta(days=1)).isoformat()
         
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM daily_counters WHERE date < ?",
-                (cutoff_date,)
+            rows = cursor.execute(
+                "SELECT rowid, date, count FROM daily_counters WHERE date < ? LIMIT ?",
+                (cutoff_date, batch_size)
+            ).fetchall()
+            if not rows:
+                return 0
+            
+            usage = {}
+            for _, date, count in rows:
+                users, messages = usage.get(date, (0, 0))
+                usage[date] = (users + 1, messages + count)
+            
+            cursor.executemany(
+                '''INSERT INTO daily_usage (date, users, messages)
+                VALUES (?, ?, ?)
+                ON CONFLICT(date) DO UPDATE SET
+                    users = users + excluded.users,
+                    messages = messages + excluded.messages''',
+                [(date, users, messages) for date, (users, messages) in usage.items()]
+            )
+            cursor.executemany(
+                "DELETE FROM daily_counters WHERE rowid = ?",
+                [(rowid,) for rowid, _, _ in rows]
             )
             conn.commit()
-        logger.info("Old counters cleaned up successfully")
+        return len(rows)
     except Exception as e:
         logger.error(f"Error cleaning up old counters: {e}")
+        return 0
+
+@_timed
+def optimize_database(vacuum_pages: int = 1000):
+    """Обновление статистики планировщика и частичное освобождение страниц"""
+    try:
+        conn = get_connection()
+        conn.execute("PRAGMA optimize")
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if auto_vacuum == 2:
+            conn.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})").fetchall()
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        logger.info("Database optimized")
+    except Exception as e:
+        logger.error(f"Error optimizing database: {e}")
+
+@_timed
+def save_context(chat_id: int, user_id: int, history: list, summary: str = ""):
+    """Сохранение истории диалога пользователя в чате"""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                '''INSERT OR REPLACE INTO conversation_contexts
+                (chat_id, user_id, history, summary, updated_at)
+                VALUES (?, ?, ?, ?, ?)''',
+                (chat_id, user_id, json.dumps(history, ensure_ascii=False), summary, datetime.utcnow().isoformat())
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error saving context: {e}")
+
+@_timed
+def save_contexts(items: list):
+    """Сохранение нескольких историй одной транзакцией: [(chat_id, user_id, history, summary), ...]"""
+    if not items:
+        return
+    try:
+        now = datetime.utcnow().isoformat()
+        with get_connection() as conn:
+            conn.executemany(
+                '''INSERT OR REPLACE INTO conversation_contexts
+                (chat_id, user_id, history, summary, updated_at)
+                VALUES (?, ?, ?, ?, ?)''',
+                [(chat_id, user_id, json.dumps(history, ensure_ascii=False), summary, now)
+                 for chat_id, user_id, history, summary in items]
+            )
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error saving contexts: {e}")
+
+@_timed
+def load_context(chat_id: int, user_id: int):
+    """Загрузка сохраненной истории диалога и ее краткого содержания (None, если их нет)"""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT history, summary FROM conversation_contexts WHERE chat_id = ? AND user_id = ?",
+                (chat_id, user_id)
+            )
+            result = cursor.fetchone()
+            return (json.loads(result[0]), result[1]) if result else None
+    except Exception as e:
+        logger.error(f"Error loading context: {e}")
+        return None
+
+@_timed
+def delete_context(chat_id: int, user_id: int) -> bool:
+    """Удаление сохраненной истории диалога"""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM conversation_contexts WHERE chat_id = ? AND user_id = ?",
+                (chat_id, user_id)
+            )
+            conn.commit()
+            return cursor.rowcount > 0
+    except Exception as e:
+        logger.error(f"Error deleting context: {e}")
+        return False
+
+@_timed
+def has_context(user_id: int) -> bool:
+    """Есть ли у пользователя сохраненная история хотя бы в одном чате"""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT 1 FROM conversation_contexts WHERE user_id = ? LIMIT 1",
+                (user_id,)
+            )
+            return cursor.fetchone() is not None
+    except Exception as e:
+        logger.error(f"Error checking context: {e}")
+        return False
 
 # Инициализируем базу данных при импорте модуля
 init_db()
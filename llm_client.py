@@ -0,0 +1,192 @@
+import os
+import json
+import logging
+
+import httpx
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Конфигурация OpenAI-совместимого провайдера (VoAPI / OpenRouter)
+VOAPI_API_URL = os.environ.get("VOAPI_API_URL", "https://openrouter.ai/api/v1")
+VOAPI_API_KEY = os.environ.get("VOAPI_API_KEY", os.environ.get("NOVITA_API_KEY", ""))  # fallback
+LLM_MODEL = os.environ.get("LLM_MODEL", "deepseek/deepseek-r1-0528:free")
+
+# Параметры пула соединений и таймаутов
+LLM_POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", 20))
+LLM_POOL_KEEPALIVE = int(os.environ.get("LLM_POOL_KEEPALIVE", 10))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", 30))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 10))
+LLM_READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", 60))
+LLM_POOL_TIMEOUT = float(os.environ.get("LLM_POOL_TIMEOUT", 10))
+
+
+def extract_content(data) -> str:
+    """Извлечение текста ассистента из ответа OpenAI-совместимого API"""
+    if isinstance(data, dict):
+        # choices -> message -> content
+        try:
+            return data["choices"][0]["message"]["content"]
+        except Exception:
+            # fallback: choices[0].text
+            try:
+                return data["choices"][0]["text"]
+            except Exception:
+                # return full json if nothing matched
+                return json.dumps(data, ensure_ascii=False)
+    return str(data)
+
+
+def parse_sse_line(line: str):
+    """
+    Разбор одной строки SSE-потока /chat/completions.
+    Возвращает фрагмент текста, пустую строку для служебных строк
+    или None по окончании потока ([DONE]).
+    """
+    line = line.strip()
+    # Пустые строки разделяют события, строки с ':' - комментарии (keep-alive)
+    if not line or line.startswith(':') or not line.startswith('data:'):
+        return ''
+    data = line[len('data:'):].strip()
+    if data == '[DONE]':
+        return None
+    try:
+        event = json.loads(data)
+        choice = event["choices"][0]
+    except Exception:
+        logger.debug(f"Skipping malformed SSE event: {data[:200]}")
+        return ''
+    delta = choice.get("delta") or {}
+    return delta.get("content") or choice.get("text") or ''
+
+
+class LLMClient:
+    """Асинхронный клиент /chat/completions с общим пулом keep-alive соединений"""
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        model: str,
+        pool_size: int = LLM_POOL_SIZE,
+        pool_keepalive: int = LLM_POOL_KEEPALIVE,
+        keepalive_expiry: float = LLM_KEEPALIVE_EXPIRY,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT,
+        read_timeout: float = LLM_READ_TIMEOUT,
+        pool_timeout: float = LLM_POOL_TIMEOUT,
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.model = model
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(
+            read_timeout,
+            connect=connect_timeout,
+            pool=pool_timeout,
+        )
+        self._client = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Клиент создается лениво, чтобы привязаться к уже запущенному event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                limits=self.limits,
+                timeout=self.timeout,
+            )
+        return self._client
+
+    def build_payload(self, messages, **overrides) -> dict:
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": 800,
+        }
+        payload.update(overrides)
+        return payload
+
+    async def chat(self, messages, timeout=None) -> str:
+        """
+        POST на /chat/completions через общий пул соединений.
+        Возвращает текст ассистента или выбрасывает исключение.
+        """
+        client = self._get_client()
+        with tracing.span("llm.chat", model=self.model) as span:
+            resp = await client.post(
+                "/chat/completions",
+                json=self.build_payload(messages),
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+                extensions={"trace": span.httpx_hook},
+            )
+            span.set(status_code=resp.status_code)
+            resp.raise_for_status()
+            return extract_content(resp.json())
+
+    async def stream_chat(self, messages, timeout=None):
+        """
+        Потоковый запрос (stream: true) на /chat/completions.
+        Асинхронный генератор, отдающий фрагменты текста по мере поступления.
+        """
+        client = self._get_client()
+        # Спан не делается текущим: между фрагментами управление у вызывающего кода
+        span = tracing.start_span("llm.stream", model=self.model)
+        chunks = 0
+        try:
+            async with client.stream(
+                "POST",
+                "/chat/completions",
+                json=self.build_payload(messages, stream=True),
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+                extensions={"trace": span.httpx_hook},
+            ) as resp:
+                span.set(status_code=resp.status_code)
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    chunk = parse_sse_line(line)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        if not chunks:
+                            span.set(first_token_ms=round(span.elapsed_ms(), 1))
+                        chunks += 1
+                        yield chunk
+        except GeneratorExit:
+            # Потребитель прекратил чтение потока - это не ошибка запроса
+            span.set(chunks=chunks)
+            span.end()
+            raise
+        except BaseException as e:
+            span.set(chunks=chunks)
+            span.end(e)
+            raise
+        span.set(chunks=chunks)
+        span.end()
+
+    async def ping(self, timeout: float = 5) -> bool:
+        """Проверка доступности провайдера (GET /models)"""
+        try:
+            resp = await self._get_client().get("/models", timeout=timeout)
+            return resp.status_code < 500
+        except httpx.HTTPError as e:
+            logger.warning(f"LLM provider {self.base_url} is unreachable: {e}")
+            return False
+
+    async def aclose(self):
+        """Закрытие пула соединений"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+
+# Общий клиент провайдера по умолчанию
+llm_client = LLMClient(VOAPI_API_URL, VOAPI_API_KEY, LLM_MODEL)
@@ -0,0 +1,350 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+
+import httpx
+
+from metrics import Histogram
+from llm_client import LLMClient, llm_client
+from resilience import (
+    CircuitBreaker,
+    ProviderUnavailable,
+    is_retryable,
+    retry_after_seconds,
+    backoff_delay,
+    LLM_RETRY_DEADLINE,
+    LLM_RETRY_MAX_ATTEMPTS
+)
+
+logger = logging.getLogger(__name__)
+
+# Список бэкендов в формате JSON:
+# [{"name": "...", "url": "...", "api_key_env": "...", "model": "..."}, ...]
+LLM_BACKENDS = os.getenv("LLM_BACKENDS", "")
+
+# Окно статистики задержек и ошибок для каждого бэкенда
+LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", 50))
+LLM_MAX_ERROR_RATE = float(os.getenv("LLM_MAX_ERROR_RATE", 0.5))
+LLM_MIN_SAMPLES = 5
+
+# Хеджирование: второй запрос, если первый не ответил к заданному перцентилю задержки
+# (для потокового ответа - времени до первого фрагмента)
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", 0.95))
+LLM_HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", 15))
+
+# Длительность запросов к LLM по бэкенду и исходу
+LLM_REQUEST_SECONDS = Histogram(
+    "llm_request_seconds",
+    "Duration of chat completion requests",
+    ("backend", "mode", "outcome")
+)
+
+def request_outcome(error: Exception = None) -> str:
+    if error is None:
+        return "success"
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        if status == 429:
+            return "rate_limited"
+        return "server_error" if status >= 500 else "client_error"
+    return "error"
+
+class BackendStats:
+    """Скользящая статистика задержек и ошибок бэкенда"""
+
+    def __init__(self, window: int = LLM_STATS_WINDOW):
+        self.latencies = deque(maxlen=window)
+        # Время до первого фрагмента потокового ответа (для хеджирования потока)
+        self.first_chunk = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+
+    def record(self, latency: float, ok: bool):
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+
+    def record_first_chunk(self, latency: float):
+        self.first_chunk.append(latency)
+
+    def percentile(self, p: float, samples=None):
+        samples = self.latencies if samples is None else samples
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(p * len(ordered)))
+        return ordered[index]
+
+    @property
+    def p50(self):
+        return self.percentile(0.5)
+
+    @property
+    def p95(self):
+        return self.percentile(0.95)
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    @property
+    def healthy(self) -> bool:
+        return len(self.outcomes) < LLM_MIN_SAMPLES or self.error_rate < LLM_MAX_ERROR_RATE
+
+class Backend:
+    def __init__(self, name: str, client: LLMClient):
+        self.name = name
+        self.client = client
+        self.stats = BackendStats()
+        self.breaker = CircuitBreaker()
+
+    @property
+    def model(self) -> str:
+        return self.client.model
+
+def load_backends() -> list:
+    """Бэкенды из LLM_BACKENDS или единственный провайдер по умолчанию"""
+    if not LLM_BACKENDS:
+        return [Backend("default", llm_client)]
+    backends = []
+    for index, spec in enumerate(json.loads(LLM_BACKENDS)):
+        api_key = spec.get("api_key") or os.getenv(spec.get("api_key_env", ""), "")
+        client = LLMClient(spec["url"], api_key, spec["model"])
+        backends.append(Backend(spec.get("name", f"backend{index}"), client))
+    return backends
+
+class LLMRouter:
+    """
+    Маршрутизатор запросов: упорядоченный список бэкендов, выбор самого быстрого
+    здорового по скользящей медиане задержки и опциональный хеджированный запрос.
+    """
+
+    def __init__(self, backends: list, hedge: bool = LLM_HEDGE,
+                 hedge_percentile: float = LLM_HEDGE_PERCENTILE):
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+
+    @property
+    def model_key(self) -> str:
+        return ",".join(backend.model for backend in self.backends)
+
+    def available(self) -> bool:
+        """Есть ли бэкенд, чей автомат отключения пропустит запрос"""
+        return any(backend.breaker.available() for backend in self.backends)
+
+    def ranked(self, tried=()) -> list:
+        """
+        Доступные бэкенды в порядке предпочтения: здоровые по p50, затем по доле ошибок.
+        Бэкенды с разомкнутым автоматом отключения не участвуют. Уже опробованные
+        в этом запросе (tried) идут в конце: повтор уходит на следующий бэкенд.
+        """
+        def sort_key(item):
+            index, backend = item
+            stats = backend.stats
+            if stats.healthy:
+                # Бэкенды без статистики пробуются в порядке списка
+                return (backend in tried, 0, stats.p50 or 0.0, index)
+            return (backend in tried, 1, stats.error_rate, index)
+        candidates = [item for item in enumerate(self.backends) if item[1].breaker.available()]
+        return [backend for _, backend in sorted(candidates, key=sort_key)]
+
+    def _record_failure(self, backend: Backend, started: float, error: Exception, mode: str = "chat"):
+        latency = time.monotonic() - started
+        backend.stats.record(latency, False)
+        LLM_REQUEST_SECONDS.observe(latency, backend=backend.name, mode=mode, outcome=request_outcome(error))
+        if is_retryable(error):
+            backend.breaker.record_failure()
+        else:
+            backend.breaker.release_probe()
+
+    def _record_success(self, backend: Backend, started: float, mode: str = "chat"):
+        latency = time.monotonic() - started
+        backend.stats.record(latency, True)
+        LLM_REQUEST_SECONDS.observe(latency, backend=backend.name, mode=mode, outcome="success")
+        backend.breaker.record_success()
+
+    async def _call(self, backend: Backend, messages) -> str:
+        if not backend.breaker.allow():
+            raise ProviderUnavailable(f"LLM backend {backend.name} circuit is open")
+        started = time.monotonic()
+        try:
+            result = await backend.client.chat(messages)
+        except asyncio.CancelledError:
+            backend.breaker.release_probe()
+            raise
+        except Exception as e:
+            self._record_failure(backend, started, e)
+            raise
+        self._record_success(backend, started)
+        return result
+
+    def _order_or_fail(self, tried=()) -> list:
+        order = self.ranked(tried)
+        if not order:
+            raise ProviderUnavailable("All LLM backends are unavailable")
+        return order
+
+    async def _retry_delay(self, attempt: int, error: Exception, deadline: float):
+        """Пауза перед повтором либо исключение, если повторять нельзя"""
+        if not (is_retryable(error) or isinstance(error, ProviderUnavailable)):
+            raise error
+        if attempt + 1 >= LLM_RETRY_MAX_ATTEMPTS:
+            raise error
+        retry_after = retry_after_seconds(error)
+        delay = retry_after if retry_after is not None else backoff_delay(attempt)
+        if time.monotonic() + delay >= deadline:
+            raise error
+        logger.warning(f"LLM request failed ({error!r}), retry {attempt + 1} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    async def chat(self, messages, deadline: float = LLM_RETRY_DEADLINE) -> str:
+        """Запрос с повторами (экспоненциальная задержка, Retry-After) в пределах дедлайна"""
+        deadline_at = time.monotonic() + deadline
+        attempt = 0
+        tried = set()
+        while True:
+            try:
+                return await self._attempt(messages, tried)
+            except ProviderUnavailable as e:
+                if not self.available():
+                    raise
+                await self._retry_delay(attempt, e, deadline_at)
+            except Exception as e:
+                await self._retry_delay(attempt, e, deadline_at)
+            attempt += 1
+
+    async def _attempt(self, messages, tried: set) -> str:
+        order = self._order_or_fail(tried)
+        _, result = await self._hedged(order, tried, lambda backend: self._call(backend, messages))
+        return result
+
+    async def _hedged(self, order: list, tried: set, call, discard=None, first_chunk: bool = False):
+        """
+        Вызов call(backend) на лучшем бэкенде; если он не ответил к перцентилю
+        своей задержки, тот же вызов на следующем - побеждает первый успешный,
+        проигравший отменяется. discard освобождает лишний успешный результат
+        (оба ответа пришли одновременно). Возвращает (бэкенд, результат).
+        """
+        primary = order[0]
+        tried.add(primary)
+        if not self.hedge or len(order) < 2:
+            return primary, await call(primary)
+
+        samples = primary.stats.first_chunk if first_chunk else primary.stats.latencies
+        delay = primary.stats.percentile(self.hedge_percentile, samples) or LLM_HEDGE_DEFAULT_DELAY
+        tasks = {asyncio.ensure_future(call(primary)): primary}
+        pending = set(tasks)
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                task = done.pop()
+                return primary, task.result()
+
+            secondary = order[1]
+            tried.add(secondary)
+            logger.info(f"Hedging LLM request: {primary.name} slower than {delay:.1f}s, trying {secondary.name}")
+            tasks[asyncio.ensure_future(call(secondary))] = secondary
+            pending = set(tasks)
+            winner = None
+            error = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                    elif winner is None:
+                        winner = task
+                    elif discard is not None:
+                        await discard(task.result())
+            if winner is None:
+                raise error
+            return tasks[winner], winner.result()
+        finally:
+            # Проигравший запрос отменяется
+            for task in pending:
+                task.cancel()
+
+    async def _open_stream(self, backend: Backend, messages):
+        """Начало потока: запрос до первого фрагмента. Возвращает (поток, первый фрагмент, начало)"""
+        if not backend.breaker.allow():
+            raise ProviderUnavailable(f"LLM backend {backend.name} circuit is open")
+        started = time.monotonic()
+        stream = backend.client.stream_chat(messages)
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except asyncio.CancelledError:
+            backend.breaker.release_probe()
+            await stream.aclose()
+            raise
+        except Exception as e:
+            self._record_failure(backend, started, e, mode="stream")
+            raise
+        backend.stats.record_first_chunk(time.monotonic() - started)
+        return stream, first, started
+
+    async def stream_chat(self, messages, deadline: float = LLM_RETRY_DEADLINE):
+        """
+        Потоковый запрос к самому быстрому бэкенду (при LLM_HEDGE - гонка двух
+        бэкендов до первого фрагмента). Если запрос упал до первого фрагмента,
+        он повторяется (с учетом Retry-After) на следующем доступном бэкенде;
+        после первого фрагмента ошибка пробрасывается.
+        """
+        deadline_at = time.monotonic() + deadline
+        attempt = 0
+        tried = set()
+        while True:
+            try:
+                order = self._order_or_fail(tried)
+                backend, (stream, first, started) = await self._hedged(
+                    order,
+                    tried,
+                    lambda candidate: self._open_stream(candidate, messages),
+                    discard=lambda opened: opened[0].aclose(),
+                    first_chunk=True
+                )
+            except ProviderUnavailable as e:
+                if not self.available():
+                    raise
+                await self._retry_delay(attempt, e, deadline_at)
+                attempt += 1
+                continue
+            except Exception as e:
+                await self._retry_delay(attempt, e, deadline_at)
+                attempt += 1
+                continue
+            break
+
+        try:
+            if first is not None:
+                yield first
+                async for chunk in stream:
+                    yield chunk
+        except (asyncio.CancelledError, GeneratorExit):
+            backend.breaker.release_probe()
+            await stream.aclose()
+            raise
+        except Exception as e:
+            self._record_failure(backend, started, e, mode="stream")
+            raise
+        self._record_success(backend, started, mode="stream")
+
+    async def ping(self) -> bool:
+        """Доступен ли хотя бы один бэкенд"""
+        results = await asyncio.gather(*(backend.client.ping() for backend in self.backends))
+        return any(results)
+
+    async def aclose(self):
+        for backend in self.backends:
+            await backend.client.aclose()
+
+llm_router = LLMRouter(load_backends())
@@ -0,0 +1,74 @@
+import os
+import time
+import logging
+import threading
+
+import database
+from context_store import context_store
+
+logger = logging.getLogger(__name__)
+
+# Периодичность обслуживания и размер порции удаления
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", 1800))
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", 1000))
+MAINTENANCE_BATCH_PAUSE = float(os.getenv("MAINTENANCE_BATCH_PAUSE", 0.05))
+OPTIMIZE_INTERVAL = float(os.getenv("OPTIMIZE_INTERVAL", 6 * 3600))
+
+class MaintenanceWorker:
+    """
+    Фоновое обслуживание БД в отдельном потоке: порционная очистка старых
+    счетчиков со сворачиванием в daily_usage, вытеснение простаивающих
+    диалогов и периодический PRAGMA optimize / incremental_vacuum.
+    """
+
+    def __init__(self, interval: float = MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_optimize = time.monotonic()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="db-maintenance", daemon=True)
+        self._thread.start()
+        logger.info("Maintenance worker started")
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def cleanup_counters(self) -> int:
+        """Удаление старых счетчиков порциями с паузами для конкурирующих записей"""
+        total = 0
+        while not self._stop.is_set():
+            deleted = database.cleanup_old_counters(MAINTENANCE_BATCH_SIZE)
+            total += deleted
+            if deleted < MAINTENANCE_BATCH_SIZE:
+                break
+            self._stop.wait(MAINTENANCE_BATCH_PAUSE)
+        return total
+
+    def run_once(self):
+        try:
+            deleted = self.cleanup_counters()
+            if deleted:
+                logger.info(f"Rolled up and removed {deleted} old daily counters")
+
+            context_store.evict_idle()
+
+            if time.monotonic() - self._last_optimize >= OPTIMIZE_INTERVAL:
+                database.optimize_database()
+                self._last_optimize = time.monotonic()
+        except Exception as e:
+            logger.error(f"Maintenance run failed: {e}")
+
+maintenance_worker = MaintenanceWorker()
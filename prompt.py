@@ -0,0 +1,111 @@
+import os
+from functools import lru_cache
+
+# Бюджет токенов на весь запрос (персонаж + резюме + история + новое сообщение)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 4000))
+
+# Сколько записей истории хранится максимум, даже если они укладываются в бюджет
+HISTORY_MAX_ENTRIES = int(os.getenv("HISTORY_MAX_ENTRIES", 40))
+
+# Сворачивание в резюме запускается, когда из окна выпало не меньше записей
+# (иначе заполненное окно дает запрос резюме на каждое сообщение)
+SUMMARY_FOLD_MIN_ENTRIES = int(os.getenv("SUMMARY_FOLD_MIN_ENTRIES", 10))
+
+# Жесткий предел хранимой истории: соблюдается, даже если резюме не удается получить
+HISTORY_STORE_MAX_ENTRIES = max(
+    int(os.getenv("HISTORY_STORE_MAX_ENTRIES", 80)),
+    HISTORY_MAX_ENTRIES + SUMMARY_FOLD_MIN_ENTRIES
+)
+
+# Максимальная длина краткого содержания старых реплик (в символах)
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", 1500))
+
+# Накладные расходы на одно сообщение в формате chat completions
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Средняя длина токена для смешанного русско-английского текста
+CHARS_PER_TOKEN = 3
+
+@lru_cache(maxsize=8192)
+def estimate_tokens(text: str) -> int:
+    """Приблизительная оценка числа токенов (кэшируется по тексту)"""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD
+
+def system_prompt(persona: str, summary: str) -> str:
+    if not summary:
+        return persona
+    return f"{persona}\n\nКраткое содержание более ранней переписки с пользователем:\n{summary}"
+
+def build_prompt(persona: str, summary: str, history: list, user_message: dict,
+                 budget: int = PROMPT_TOKEN_BUDGET):
+    """
+    Сборка запроса в пределах бюджета токенов: история заполняется
+    от новых записей к старым, пока хватает бюджета.
+    Возвращает (messages, dropped) - dropped старых записей не вошли в окно.
+    """
+    system = {"role": "system", "content": system_prompt(persona, summary)}
+    used = message_tokens(system) + message_tokens(user_message)
+
+    start = len(history)
+    for index in range(len(history) - 1, -1, -1):
+        cost = message_tokens(history[index])
+        if used + cost > budget:
+            break
+        used += cost
+        start = index
+
+    # Окно не должно начинаться с ответа ассистента без вопроса пользователя
+    while start < len(history) and history[start]["role"] == "assistant":
+        start += 1
+
+    messages = [system]
+    messages.extend(history[start:])
+    messages.append(user_message)
+    return messages, start
+
+def split_history(history: list, dropped: int):
+    """
+    Разделение истории после ответа на выпавшие из окна записи
+    (для резюме) и оставшиеся в окне.
+    """
+    keep_from = max(dropped, len(history) - HISTORY_MAX_ENTRIES)
+    return history[:keep_from], history[keep_from:]
+
+def fold_due(folded: list) -> bool:
+    """Пора ли сворачивать выпавшие из окна записи в резюме"""
+    return len(folded) >= SUMMARY_FOLD_MIN_ENTRIES
+
+def cap_history(history: list) -> list:
+    """Обрезка хранимой истории до жесткого предела (старейшие записи теряются)"""
+    if len(history) <= HISTORY_STORE_MAX_ENTRIES:
+        return history
+    return history[-HISTORY_STORE_MAX_ENTRIES:]
+
+def format_turns(turns: list, assistant_name: str = "Алиса") -> str:
+    """Текстовое представление реплик для резюмирования"""
+    lines = []
+    for turn in turns:
+        if turn["role"] == "assistant":
+            lines.append(f"{assistant_name}: {turn['content']}")
+        else:
+            # Сообщения пользователей уже имеют формат 'Имя: текст'
+            lines.append(turn["content"])
+    return "\n".join(lines)
+
+def build_summary_request(summary: str, turns: list) -> list:
+    """Запрос на обновление краткого содержания диалога"""
+    return [
+        {
+            "role": "system",
+            "content": "Ты ведешь краткий конспект диалога. Объедини прежнее резюме и новые реплики "
+                       "в одно связное резюме на русском языке: кто собеседник, о чем говорили, "
+                       "важные факты и договоренности. Не более 120 слов, без вступлений, только текст резюме."
+        },
+        {
+            "role": "user",
+            "content": f"Прежнее резюме:\n{summary or 'нет'}\n\nНовые реплики:\n{format_turns(turns)}"
+        }
+    ]
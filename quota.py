@@ -0,0 +1,221 @@
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Базовый дневной лимит и бонус за каждого приглашенного пользователя
+BASE_LIMIT = 35
+REFERRAL_BONUS = 3
+
+# Максимальное число снимков квот в памяти
+QUOTA_CACHE_SIZE = int(os.getenv("QUOTA_CACHE_SIZE", 50000))
+
+def utc_today() -> str:
+    return datetime.utcnow().strftime("%Y-%m-%d")
+
+@dataclass
+class QuotaSnapshot:
+    """Снимок квоты пользователя: рефералы, бонусы и использование за день"""
+    referrals: int
+    bonus: int
+    date: str
+    used: int
+
+    @property
+    def referral_bonus(self) -> int:
+        return self.referrals * REFERRAL_BONUS
+
+    @property
+    def total_limit(self) -> int:
+        return BASE_LIMIT + self.referral_bonus + self.bonus
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.total_limit - self.used)
+
+    @property
+    def exhausted(self) -> bool:
+        return self.used >= self.total_limit
+
+class QuotaCache:
+    """
+    LRU-кэш снимков квот. Снимок загружается из БД один раз и далее
+    обновляется при записи; при смене дня (UTC) перечитывается только счетчик.
+    """
+
+    def __init__(self, max_entries: int = QUOTA_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, user_id: int, today: str) -> QuotaSnapshot:
+        return QuotaSnapshot(
+            referrals=database.get_referral_count(user_id),
+            bonus=database.get_bonus_count(user_id),
+            date=today,
+            used=database.get_daily_counter(user_id, today)
+        )
+
+    def get(self, user_id: int) -> QuotaSnapshot:
+        today = utc_today()
+        with self._lock:
+            snapshot = self._entries.get(user_id)
+            if snapshot is not None:
+                self._entries.move_to_end(user_id)
+                if snapshot.date == today:
+                    return snapshot
+
+        if snapshot is None:
+            snapshot = self._load(user_id, today)
+        else:
+            # Новый день: рефералы и бонусы остаются актуальными
+            snapshot = QuotaSnapshot(
+                referrals=snapshot.referrals,
+                bonus=snapshot.bonus,
+                date=today,
+                used=database.get_daily_counter(user_id, today)
+            )
+
+        with self._lock:
+            # Пока снимок читался из БД, другой поток мог сохранить и уже обновить свой:
+            # он не старше нашего, заменять его нельзя (потерялись бы списания)
+            current = self._entries.get(user_id)
+            if current is not None and current.date == today:
+                self._entries.move_to_end(user_id)
+                return current
+            self._entries[user_id] = snapshot
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return snapshot
+
+    def peek(self, user_id: int):
+        """Актуальный снимок из кэша без обращения к БД (None, если его нет)"""
+        today = utc_today()
+        with self._lock:
+            snapshot = self._entries.get(user_id)
+            if snapshot is None or snapshot.date != today:
+                return None
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def _update(self, user_id: int, **changes):
+        with self._lock:
+            snapshot = self._entries.get(user_id)
+            if snapshot is None:
+                return
+            for field, value in changes.items():
+                setattr(snapshot, field, value)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def on_message_counted(self, user_id: int, date: str, delta: int = 1):
+        with self._lock:
+            snapshot = self._entries.get(user_id)
+            if snapshot is not None and snapshot.date == date:
+                snapshot.used = max(0, snapshot.used + delta)
+
+    def on_referral_added(self, referrer_id: int):
+        with self._lock:
+            snapshot = self._entries.get(referrer_id)
+            if snapshot is not None:
+                snapshot.referrals += 1
+
+    def on_bonus_set(self, user_id: int, bonus_count: int):
+        self._update(user_id, bonus=bonus_count)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+quota_cache = QuotaCache()
+
+# Функции записи, поддерживающие кэш в согласованном состоянии
+
+def get_quota(user_id: int) -> QuotaSnapshot:
+    """Получение снимка квоты пользователя"""
+    return quota_cache.get(user_id)
+
+def add_referral(invited_id: int, referrer_id: int) -> bool:
+    added = database.add_referral(invited_id, referrer_id)
+    if added:
+        quota_cache.on_referral_added(referrer_id)
+    return added
+
+def set_bonus_count(user_id: int, bonus_count: int):
+    database.set_bonus_count(user_id, bonus_count)
+    quota_cache.on_bonus_set(user_id, bonus_count)
+
+def apply_bonus_batch(batch_key: str, entries: list, source: str = ""):
+    """Пакетное изменение бонусов (см. database.apply_bonus_batch)"""
+    results = database.apply_bonus_batch(batch_key, entries, source)
+    for user_id, _, bonus_count in results or ():
+        quota_cache.on_bonus_set(user_id, bonus_count)
+    return results
+
+def parse_bonus_lines(text: str):
+    """
+    Разбор строк вида "user_id,delta" (разделитель: запятая, точка с запятой,
+    табуляция или пробел). Пустые строки, комментарии (#) и заголовок
+    пропускаются. Возвращает (entries, errors), где errors - номера и тексты
+    строк, которые не удалось разобрать.
+    """
+    entries = []
+    errors = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = [part for part in re.split(r"[,;\t ]+", line) if part]
+        if len(parts) == 2 and re.fullmatch(r"\d+", parts[0]) and re.fullmatch(r"[+-]?\d+", parts[1]):
+            entries.append((int(parts[0]), int(parts[1])))
+        elif number == 1 and not any(char.isdigit() for char in line):
+            continue
+        else:
+            errors.append((number, line))
+    return entries, errors
+
+def increment_daily_counter(user_id: int, date: str, delta: int = 1):
+    database.increment_daily_counter(user_id, date, delta)
+    quota_cache.on_message_counted(user_id, date, delta)
+
+def refund_message(user_id: int, date: str, count: int = 1):
+    """Возврат списанных сообщений (ответ не был получен)"""
+    increment_daily_counter(user_id, date, -count)
+
+# Асинхронные версии для обработчиков: снимок из кэша отдается сразу,
+# обращения к БД выполняются в потоках БД
+
+async def aget_quota(user_id: int) -> QuotaSnapshot:
+    snapshot = quota_cache.peek(user_id)
+    if snapshot is not None:
+        return snapshot
+    return await database.run_async(quota_cache.get, user_id)
+
+async def aadd_referral(invited_id: int, referrer_id: int) -> bool:
+    return await database.run_async(add_referral, invited_id, referrer_id)
+
+async def aset_bonus_count(user_id: int, bonus_count: int):
+    await database.run_async(set_bonus_count, user_id, bonus_count)
+
+async def aapply_bonus_batch(batch_key: str, entries: list, source: str = ""):
+    return await database.run_async(apply_bonus_batch, batch_key, entries, source)
+
+async def aincrement_daily_counter(user_id: int, date: str, delta: int = 1):
+    if database.DB_WRITE_BEHIND:
+        # Приращение только попадает в буфер в памяти
+        increment_daily_counter(user_id, date, delta)
+        return
+    await database.run_async(increment_daily_counter, user_id, date, delta)
+
+async def arefund_message(user_id: int, date: str, count: int = 1):
+    await aincrement_daily_counter(user_id, date, -count)
@@ -0,0 +1,100 @@
+import os
+import re
+import time
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# Кэш ответов на первые сообщения без истории диалога
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1000))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 6 * 3600))
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", 3))
+
+RESPONSE_CACHE_LOOKUPS = Counter("response_cache_lookups_total", "Response cache lookups", ("result",))
+
+# Заполнители имени собеседника в сохраненных ответах
+FULL_NAME_PLACEHOLDER = "\x00full_name\x00"
+FIRST_NAME_PLACEHOLDER = "\x00first_name\x00"
+
+def normalize_text(text: str) -> str:
+    """Нормализация текста для ключа кэша: регистр, ё, пунктуация и пробелы"""
+    text = text.lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+class _Entry:
+    __slots__ = ("variants", "expires_at")
+
+    def __init__(self, expires_at: float):
+        self.variants = []
+        self.expires_at = expires_at
+
+class ResponseCache:
+    """
+    LRU-кэш ответов с TTL. Для каждого ключа копится несколько вариантов ответа;
+    пока их меньше нужного, запрос считается промахом и идет к модели,
+    чтобы ответы не выглядели шаблонными.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL,
+                 variants: int = RESPONSE_CACHE_VARIANTS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text: str, model: str, persona_hash: str):
+        return (normalize_text(text), model, persona_hash)
+
+    def get(self, key, full_name: str = "", first_name: str = ""):
+        """Случайный вариант ответа или None при промахе"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None or len(entry.variants) < self.variants:
+                RESPONSE_CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(key)
+            RESPONSE_CACHE_LOOKUPS.inc(result="hit")
+            template = random.choice(entry.variants)
+        return template.replace(FULL_NAME_PLACEHOLDER, full_name).replace(FIRST_NAME_PLACEHOLDER, first_name)
+
+    def put(self, key, response: str, full_name: str = "", first_name: str = ""):
+        """Сохранение варианта ответа (имя собеседника заменяется заполнителем)"""
+        template = response
+        if full_name:
+            template = template.replace(full_name, FULL_NAME_PLACEHOLDER)
+        if first_name:
+            template = template.replace(first_name, FIRST_NAME_PLACEHOLDER)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(time.monotonic() + self.ttl)
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if template not in entry.variants and len(entry.variants) < self.variants:
+                entry.variants.append(template)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+response_cache = ResponseCache()
+
+Gauge("response_cache_entries", "Keys held in the response cache", callback=lambda: len(response_cache))
@@ -0,0 +1,148 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Глобальное ограничение одновременных запросов к LLM
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+
+class Job:
+    """
+    Очередной ход диалога для ключа (chat_id, user_id).
+    Пока ход ждет очереди, в него сливаются новые сообщения того же пользователя.
+    charges - списания за сообщения хода (для возврата, если ответа не будет).
+    Используется как асинхронный контекстный менеджер: вход - получение слота.
+    """
+
+    def __init__(self, scheduler, key, lane):
+        self.scheduler = scheduler
+        self.key = key
+        self.lane = lane
+        self.items = []
+        self.charges = []
+        self.started = False
+        self._ready = asyncio.Event()
+
+    def add(self, item, charge=None):
+        self.items.append(item)
+        if charge is not None:
+            self.charges.append(charge)
+
+    async def __aenter__(self):
+        with tracing.span("scheduler.wait", lane=self.lane, queued=self.scheduler.queued):
+            await self.scheduler._acquire(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.scheduler._release(self)
+        return False
+
+class LLMScheduler:
+    """
+    Планировщик запросов к LLM: общий лимит параллельности, справедливая
+    очередь по чатам (взвешенный round-robin) и не более одного запроса
+    на ключ (chat_id, user_id) одновременно.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, weights: dict = None):
+        self.max_concurrency = max_concurrency
+        self.weights = weights or {}
+        self._lanes = OrderedDict()
+        self._credits = {}
+        self._pending = {}
+        self._held = {}
+        self._active = set()
+        self._running = 0
+
+    def submit(self, key, lane, item, charge=None):
+        """
+        Постановка сообщения в очередь. Возвращает новый Job или None,
+        если сообщение слито в уже ожидающий ход того же пользователя.
+        charge - списание за сообщение, сохраняется вместе с ним в ходе.
+        """
+        job = self._pending.get(key)
+        if job is not None:
+            job.add(item, charge)
+            return None
+        job = Job(self, key, lane)
+        job.add(item, charge)
+        self._pending[key] = job
+        return job
+
+    def _weight(self, lane) -> int:
+        return max(1, self.weights.get(lane, 1))
+
+    def _enqueue(self, job: Job):
+        if job.key in self._active:
+            # Ход ждет завершения текущего запроса этого же пользователя
+            self._held[job.key] = job
+        else:
+            self._lanes.setdefault(job.lane, deque()).append(job)
+
+    def _dispatch(self):
+        while self._running < self.max_concurrency and self._lanes:
+            lane, queue = next(iter(self._lanes.items()))
+            job = queue.popleft()
+            credits = self._credits.get(lane, self._weight(lane)) - 1
+
+            if not queue:
+                del self._lanes[lane]
+                self._credits.pop(lane, None)
+            elif credits <= 0:
+                # Очередь чата исчерпала свою долю в этом круге
+                self._lanes.move_to_end(lane)
+                self._credits.pop(lane, None)
+            else:
+                self._credits[lane] = credits
+
+            if self._pending.get(job.key) is job:
+                del self._pending[job.key]
+            self._running += 1
+            self._active.add(job.key)
+            job.started = True
+            job._ready.set()
+
+    def _discard(self, job: Job):
+        """Удаление так и не запущенного хода (при отмене ожидания)"""
+        if self._pending.get(job.key) is job:
+            del self._pending[job.key]
+        if self._held.get(job.key) is job:
+            del self._held[job.key]
+        queue = self._lanes.get(job.lane)
+        if queue is not None and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self._lanes[job.lane]
+                self._credits.pop(job.lane, None)
+
+    async def _acquire(self, job: Job):
+        self._enqueue(job)
+        self._dispatch()
+        try:
+            await job._ready.wait()
+        except asyncio.CancelledError:
+            if job.started:
+                self._release(job)
+            else:
+                self._discard(job)
+            raise
+
+    def _release(self, job: Job):
+        self._running -= 1
+        self._active.discard(job.key)
+        held = self._held.pop(job.key, None)
+        if held is not None:
+            self._lanes.setdefault(held.lane, deque()).append(held)
+        self._dispatch()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._lanes.values()) + len(self._held)
+
+    @property
+    def in_flight(self) -> int:
+        return self._running
@@ -0,0 +1,292 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+
+from telegram import constants
+from telegram.error import RetryAfter
+
+import tracing
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: общий на бота и для каждого чата (сообщений в секунду)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", 1))
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", 20 / 60))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", 3))
+
+# Сколько раз повторять отправку после ответа 429 (retry_after)
+TG_SEND_MAX_RETRIES = int(os.getenv("TG_SEND_MAX_RETRIES", 3))
+
+# Как часто удалять корзины неактивных чатов (секунды)
+TG_BUCKET_PRUNE_INTERVAL = float(os.getenv("TG_BUCKET_PRUNE_INTERVAL", 60))
+
+# Приоритеты: ответы важнее правок потокового ответа, правки важнее индикатора набора
+PRIORITY_REPLY = 0
+PRIORITY_EDIT = 1
+PRIORITY_TYPING = 2
+
+FLOOD_WAITS = Counter("telegram_flood_waits_total", "Telegram 429 responses handled by the send queue")
+DROPPED_SENDS = Counter("telegram_sends_coalesced_total", "Queued edits and typing actions replaced by newer ones")
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не более capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд можно взять токен (0 - можно сейчас)"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def idle(self, now: float) -> bool:
+        """Корзина полна и не на паузе - она не отличается от новой"""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Пауза после ответа 429: токены не выдаются seconds секунд"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+
+class _Request:
+    __slots__ = ("chat_id", "priority", "seq", "factory", "future", "coalesce_key", "attempts", "parent", "queued_at")
+
+    def __init__(self, chat_id, priority, seq, factory, future, coalesce_key):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.factory = factory
+        self.future = future
+        self.coalesce_key = coalesce_key
+        self.attempts = 0
+        # Спан обновления, от имени которого идет отправка
+        self.parent = tracing.current_span()
+        self.queued_at = time.monotonic()
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if hasattr(retry_after, "total_seconds"):
+        retry_after = retry_after.total_seconds()
+    return float(retry_after)
+
+def _observe(future: asyncio.Future):
+    # Ошибку обрабатывает вызывающий код, если он ждет результата;
+    # иначе она не должна попадать в журнал asyncio как неполученная
+    if not future.cancelled():
+        future.exception()
+
+def _chain(source: asyncio.Future, target: asyncio.Future):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+class SendQueue:
+    """
+    Очередь исходящих запросов к Telegram. Отправка идет с учетом общей и
+    корзин токенов каждого чата, по приоритету (ответ > правка > набор текста),
+    не более одного запроса на чат одновременно (порядок внутри чата сохраняется).
+    Ответ 429 приостанавливает чат на retry_after, запрос повторяется.
+    Вызывающий код получает future и сам решает, ждать ли результата.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = TG_GLOBAL_RATE,
+        private_rate: float = TG_PRIVATE_RATE,
+        group_rate: float = TG_GROUP_RATE,
+        chat_burst: int = TG_CHAT_BURST,
+        max_retries: int = TG_SEND_MAX_RETRIES
+    ):
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._pending = []
+        self._coalescing = {}
+        self._busy = set()
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._worker = None
+        self._pruned_at = time.monotonic()
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Отрицательные id - группы и каналы с более строгим лимитом
+            rate = self.group_rate if chat_id < 0 else self.private_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def submit(self, chat_id: int, factory, priority: int = PRIORITY_REPLY, coalesce_key=None) -> asyncio.Future:
+        """
+        Постановка запроса: factory - функция без аргументов, возвращающая корутину.
+        Ожидающий запрос с тем же coalesce_key заменяется новым (важен только последний),
+        его future разделяется с новым вызывающим.
+        """
+        if coalesce_key is not None:
+            request = self._coalescing.get(coalesce_key)
+            if request is not None:
+                request.factory = factory
+                DROPPED_SENDS.inc()
+                return request.future
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_observe)
+        request = _Request(chat_id, priority, next(self._seq), factory, future, coalesce_key)
+        self._pending.append(request)
+        if coalesce_key is not None:
+            self._coalescing[coalesce_key] = request
+        self._ensure_worker()
+        self._wakeup.set()
+        return future
+
+    def reply(self, message, text: str, **kwargs) -> asyncio.Future:
+        return self.submit(message.chat_id, lambda: message.reply_text(text, **kwargs))
+
+    def edit(self, message, text: str, **kwargs) -> asyncio.Future:
+        key = ("edit", message.chat_id, message.message_id)
+        return self.submit(message.chat_id, lambda: message.edit_text(text, **kwargs), PRIORITY_EDIT, key)
+
+    def typing(self, bot, chat_id: int) -> asyncio.Future:
+        factory = lambda: bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
+        return self.submit(chat_id, factory, PRIORITY_TYPING, ("typing", chat_id))
+
+    def _ensure_worker(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    def _next_ready(self, now: float):
+        """Самый приоритетный запрос, чей чат свободен и может отправлять; иначе время ожидания"""
+        wait = None
+        for request in sorted(self._pending, key=lambda item: (item.priority, item.seq)):
+            if request.chat_id in self._busy:
+                continue
+            delay = self._bucket(request.chat_id).delay(now)
+            if delay <= 0:
+                return request, 0.0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _prune(self, now: float):
+        """Удаление корзин чатов без запросов: иначе они копятся для каждого чата навсегда"""
+        self._pruned_at = now
+        active = self._busy | {request.chat_id for request in self._pending}
+        idle = [
+            chat_id for chat_id, bucket in self._chats.items()
+            if chat_id not in active and bucket.idle(now)
+        ]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            if now - self._pruned_at >= TG_BUCKET_PRUNE_INTERVAL:
+                self._prune(now)
+            request, wait = self._next_ready(now)
+            if request is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            self._pending.remove(request)
+            if request.coalesce_key is not None and self._coalescing.get(request.coalesce_key) is request:
+                del self._coalescing[request.coalesce_key]
+            self._global.take(now)
+            self._bucket(request.chat_id).take(now)
+            self._busy.add(request.chat_id)
+            asyncio.get_running_loop().create_task(self._execute(request))
+
+    async def _execute(self, request: _Request):
+        try:
+            request.attempts += 1
+            with tracing.use_span(request.parent), tracing.span(
+                "telegram.send",
+                chat_id=request.chat_id,
+                priority=request.priority,
+                attempt=request.attempts,
+                queue_wait_ms=round((time.monotonic() - request.queued_at) * 1000, 1)
+            ):
+                result = await request.factory()
+        except RetryAfter as e:
+            retry_after = _retry_after_seconds(e)
+            FLOOD_WAITS.inc()
+            self._bucket(request.chat_id).block(retry_after)
+            newer = self._coalescing.get(request.coalesce_key) if request.coalesce_key is not None else None
+            if newer is not None:
+                # Пока шла попытка, поставлена более свежая правка: ее результат общий
+                newer.future.add_done_callback(lambda done: _chain(done, request.future))
+            elif request.attempts <= self.max_retries:
+                logger.warning(f"Telegram flood control for chat {request.chat_id}, retrying in {retry_after:.0f}s")
+                # Повтор сохраняет место в очереди (тот же приоритет и порядковый номер)
+                self._pending.append(request)
+                if request.coalesce_key is not None:
+                    self._coalescing[request.coalesce_key] = request
+            else:
+                logger.error(f"Giving up sending to chat {request.chat_id} after {request.attempts} flood waits")
+                request.future.set_exception(e)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
+        finally:
+            self._busy.discard(request.chat_id)
+            self._wakeup.set()
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    async def drain(self, timeout: float = 10):
+        """Ожидание отправки очереди (при остановке бота)"""
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for request in self._pending:
+            if not request.future.done():
+                request.future.cancel()
+        self._pending.clear()
+        self._coalescing.clear()
+
+send_queue = SendQueue()
+
+Gauge("telegram_send_queue_depth", "Outbound Telegram requests waiting in the send queue", callback=lambda: send_queue.depth)
@@ -0,0 +1,361 @@
+import os
+import json
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+import database
+import quota
+from quota import QuotaSnapshot, BASE_LIMIT, REFERRAL_BONUS, utc_today
+from context_store import context_store
+
+logger = logging.getLogger(__name__)
+
+# Хранилище состояния: "local" (SQLite + кэши в памяти) или "redis" (общее для нескольких экземпляров)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "alice:")
+
+# Сколько хранить дневные счетчики и неактивные диалоги в Redis (секунды)
+REDIS_COUNTER_TTL = int(os.getenv("REDIS_COUNTER_TTL", 2 * 24 * 3600))
+REDIS_CONTEXT_TTL = int(os.getenv("REDIS_CONTEXT_TTL", 30 * 24 * 3600))
+
+class StateBackend(ABC):
+    """
+    Интерфейс хранилища состояния бота: квоты (атомарное резервирование
+    сообщения), рефералы, бонусы и истории диалогов. Ключ диалога - (chat_id, user_id).
+    """
+
+    # Нужно ли локальное обслуживание SQLite (очистка счетчиков, вытеснение диалогов)
+    local = False
+
+    @abstractmethod
+    async def reserve_message(self, user_id: int):
+        """Атомарная проверка лимита и списание сообщения: (списано ли, снимок квоты)"""
+
+    @abstractmethod
+    async def refund_message(self, user_id: int, date: str, count: int = 1):
+        ...
+
+    @abstractmethod
+    async def get_quota(self, user_id: int) -> QuotaSnapshot:
+        ...
+
+    @abstractmethod
+    async def get_referrer_id(self, invited_id: int):
+        ...
+
+    @abstractmethod
+    async def add_referral(self, invited_id: int, referrer_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def apply_bonus_batch(self, batch_key: str, entries: list, source: str = ""):
+        ...
+
+    @abstractmethod
+    async def get_context(self, key) -> list:
+        ...
+
+    @abstractmethod
+    async def get_summary(self, key) -> str:
+        ...
+
+    @abstractmethod
+    async def set_context(self, key, history: list, summary: str = None):
+        ...
+
+    @abstractmethod
+    async def delete_context(self, key) -> bool:
+        ...
+
+    @abstractmethod
+    async def has_context(self, user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def check(self) -> bool:
+        """Доступность хранилища (для проверки готовности)"""
+
+    async def close(self):
+        pass
+
+class LocalStateBackend(StateBackend):
+    """Состояние одного процесса: SQLite, кэш квот и хранилище диалогов в памяти"""
+
+    local = True
+
+    def __init__(self, lock_stripes: int = 64):
+        # Резервирование сообщений одного пользователя выполняется по очереди
+        self._locks = [asyncio.Lock() for _ in range(lock_stripes)]
+
+    async def reserve_message(self, user_id: int):
+        async with self._locks[user_id % len(self._locks)]:
+            snapshot = await quota.aget_quota(user_id)
+            if snapshot.exhausted:
+                return False, snapshot
+            await quota.aincrement_daily_counter(user_id, snapshot.date)
+            return True, snapshot
+
+    async def refund_message(self, user_id: int, date: str, count: int = 1):
+        await quota.arefund_message(user_id, date, count)
+
+    async def get_quota(self, user_id: int) -> QuotaSnapshot:
+        return await quota.aget_quota(user_id)
+
+    async def get_referrer_id(self, invited_id: int):
+        return await database.run_async(database.get_referrer_id, invited_id)
+
+    async def add_referral(self, invited_id: int, referrer_id: int) -> bool:
+        return await database.run_async(quota.add_referral, invited_id, referrer_id)
+
+    async def apply_bonus_batch(self, batch_key: str, entries: list, source: str = ""):
+        return await quota.aapply_bonus_batch(batch_key, entries, source)
+
+    async def get_context(self, key) -> list:
+        return await context_store.aget(key)
+
+    async def get_summary(self, key) -> str:
+        return await context_store.aget_summary(key)
+
+    async def set_context(self, key, history: list, summary: str = None):
+        await context_store.aset(key, history, summary)
+
+    async def delete_context(self, key) -> bool:
+        return await context_store.adelete(key)
+
+    async def has_context(self, user_id: int) -> bool:
+        return await context_store.ahas_user(user_id)
+
+    async def check(self) -> bool:
+        return await database.run_async(database.check_database)
+
+    async def close(self):
+        # Истории диалогов переживают перезапуск
+        await database.run_async(context_store.spill_all)
+        database.close_connections()
+
+# Lua-скрипты выполняются в Redis атомарно
+
+# KEYS: счетчик за день, бонусы, число рефералов; ARGV: базовый лимит, бонус за реферала, TTL счетчика
+RESERVE_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local bonus = tonumber(redis.call('GET', KEYS[2]) or '0')
+local referrals = tonumber(redis.call('GET', KEYS[3]) or '0')
+local limit = tonumber(ARGV[1]) + referrals * tonumber(ARGV[2]) + bonus
+if used >= limit then
+    return {0, used, referrals, bonus}
+end
+redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return {1, used, referrals, bonus}
+"""
+
+# KEYS: счетчик за день; ARGV: сколько вернуть
+REFUND_SCRIPT = """
+local used = tonumber(redis.call('GET', KEYS[1]) or '0')
+local value = math.max(used - tonumber(ARGV[1]), 0)
+redis.call('SET', KEYS[1], value, 'KEEPTTL')
+return value
+"""
+
+# KEYS: реферер приглашенного, число рефералов реферера; ARGV: id реферера
+REFERRAL_SCRIPT = """
+if redis.call('SETNX', KEYS[1], ARGV[1]) == 1 then
+    redis.call('INCR', KEYS[2])
+    return 1
+end
+return 0
+"""
+
+# KEYS: метка пакета, журнал, затем бонусы каждого пользователя пакета;
+# ARGV: время, затем пары user_id, delta в порядке ключей бонусов
+BONUS_BATCH_SCRIPT = """
+if redis.call('SETNX', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local results = {}
+for i = 3, #KEYS do
+    local n = 2 * (i - 2)
+    local old = tonumber(redis.call('GET', KEYS[i]) or '0')
+    local value = math.max(old + tonumber(ARGV[n + 1]), 0)
+    redis.call('SET', KEYS[i], value)
+    redis.call('RPUSH', KEYS[2], cjson.encode({ARGV[n], value - old, ARGV[n + 1], value, ARGV[1]}))
+    table.insert(results, value - old)
+    table.insert(results, value)
+end
+return results
+"""
+
+class RedisStateBackend(StateBackend):
+    """
+    Общее состояние для нескольких экземпляров бота в Redis. Проверка лимита
+    и списание выполняются одним Lua-скриптом, поэтому квота не превышается
+    при параллельных сообщениях пользователя в разных процессах.
+    """
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = REDIS_PREFIX, client=None):
+        if client is None and redis is None:
+            raise RuntimeError("STATE_BACKEND=redis requires the redis package")
+        self.prefix = prefix
+        # client - готовый асинхронный клиент (например, fakeredis для проверки скриптов)
+        self.client = client if client is not None else redis.from_url(url, decode_responses=True)
+        self._reserve = self.client.register_script(RESERVE_SCRIPT)
+        self._refund = self.client.register_script(REFUND_SCRIPT)
+        self._referral = self.client.register_script(REFERRAL_SCRIPT)
+        self._bonus_batch = self.client.register_script(BONUS_BATCH_SCRIPT)
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ":".join(str(part) for part in parts)
+
+    def _quota_keys(self, user_id: int, date: str) -> list:
+        return [
+            self._key("daily", user_id, date),
+            self._key("bonus", user_id),
+            self._key("referrals", user_id)
+        ]
+
+    async def reserve_message(self, user_id: int):
+        date = utc_today()
+        allowed, used, referrals, bonus = await self._reserve(
+            keys=self._quota_keys(user_id, date),
+            args=[BASE_LIMIT, REFERRAL_BONUS, REDIS_COUNTER_TTL]
+        )
+        # Счетчик в снимке - с учетом списанного сообщения
+        return bool(allowed), QuotaSnapshot(referrals=referrals, bonus=bonus, date=date, used=used + allowed)
+
+    async def refund_message(self, user_id: int, date: str, count: int = 1):
+        await self._refund(keys=[self._key("daily", user_id, date)], args=[count])
+
+    async def get_quota(self, user_id: int) -> QuotaSnapshot:
+        date = utc_today()
+        used, bonus, referrals = await self.client.mget(self._quota_keys(user_id, date))
+        return QuotaSnapshot(
+            referrals=int(referrals or 0),
+            bonus=int(bonus or 0),
+            date=date,
+            used=int(used or 0)
+        )
+
+    async def get_referrer_id(self, invited_id: int):
+        referrer_id = await self.client.get(self._key("referrer", invited_id))
+        return int(referrer_id) if referrer_id is not None else None
+
+    async def add_referral(self, invited_id: int, referrer_id: int) -> bool:
+        added = await self._referral(
+            keys=[self._key("referrer", invited_id), self._key("referrals", referrer_id)],
+            args=[referrer_id]
+        )
+        return bool(added)
+
+    async def apply_bonus_batch(self, batch_key: str, entries: list, source: str = ""):
+        # Все ключи, которые трогает скрипт, передаются в KEYS (требование Redis Cluster и прокси)
+        keys = [self._key("bonus_batch", batch_key), self._key("bonus_ledger")]
+        args = [datetime.utcnow().isoformat()]
+        for user_id, delta in entries:
+            keys.append(self._key("bonus", user_id))
+            args.extend((user_id, delta))
+        values = await self._bonus_batch(keys=keys, args=args)
+        if values is None:
+            logger.info(f"Bonus batch {batch_key} already applied, skipping")
+            return None
+        # Скрипт возвращает пары (фактическое изменение, новый баланс)
+        return [
+            (user_id, int(values[2 * i]), int(values[2 * i + 1]))
+            for i, (user_id, _) in enumerate(entries)
+        ]
+
+    def _context_key(self, key) -> str:
+        chat_id, user_id = key
+        return self._key("context", chat_id, user_id)
+
+    async def get_context(self, key) -> list:
+        history = await self.client.hget(self._context_key(key), "history")
+        return json.loads(history) if history else []
+
+    async def get_summary(self, key) -> str:
+        return await self.client.hget(self._context_key(key), "summary") or ""
+
+    async def set_context(self, key, history: list, summary: str = None):
+        fields = {"history": json.dumps(history, ensure_ascii=False)}
+        if summary is not None:
+            fields["summary"] = summary
+        await self._save_context(key, fields)
+
+    async def _save_context(self, key, fields: dict):
+        context_key = self._context_key(key)
+        users_key = self._key("context_chats", key[1])
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.hset(context_key, mapping=fields)
+            pipe.expire(context_key, REDIS_CONTEXT_TTL)
+            pipe.sadd(users_key, key[0])
+            pipe.expire(users_key, REDIS_CONTEXT_TTL)
+            await pipe.execute()
+
+    async def delete_context(self, key) -> bool:
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(self._context_key(key))
+            pipe.srem(self._key("context_chats", key[1]), key[0])
+            deleted, _ = await pipe.execute()
+        return bool(deleted)
+
+    async def has_context(self, user_id: int) -> bool:
+        return await self.client.scard(self._key("context_chats", user_id)) > 0
+
+    async def check(self) -> bool:
+        try:
+            return bool(await self.client.ping())
+        except Exception as e:
+            logger.error(f"Redis health check failed: {e}")
+            return False
+
+    async def close(self):
+        await self.client.aclose()
+
+async def import_local_state(target: RedisStateBackend, batch_size: int = 1000):
+    """Перенос рефералов и бонусов из локальной SQLite в Redis (при переходе на общее хранилище)"""
+    conn = database.get_connection()
+    referrals = conn.execute("SELECT invited_id, referrer_id FROM referrals").fetchall()
+    counts = conn.execute("SELECT referrer_id, count FROM referral_counts").fetchall()
+    bonuses = conn.execute("SELECT user_id, bonus_count FROM bonus_messages").fetchall()
+    
+    for start in range(0, max(len(referrals), len(counts), len(bonuses)), batch_size):
+        async with target.client.pipeline(transaction=False) as pipe:
+            for invited_id, referrer_id in referrals[start:start + batch_size]:
+                pipe.set(target._key("referrer", invited_id), referrer_id)
+            for referrer_id, count in counts[start:start + batch_size]:
+                pipe.set(target._key("referrals", referrer_id), count)
+            for user_id, bonus_count in bonuses[start:start + batch_size]:
+                pipe.set(target._key("bonus", user_id), bonus_count)
+            await pipe.execute()
+    logger.info(
+        f"Imported {len(referrals)} referrals, {len(counts)} referral counts "
+        f"and {len(bonuses)} bonus balances into Redis"
+    )
+
+def create_backend(name: str = STATE_BACKEND) -> StateBackend:
+    if name == "redis":
+        return RedisStateBackend()
+    if name != "local":
+        raise ValueError(f"Unknown STATE_BACKEND: {name}")
+    return LocalStateBackend()
+
+state = create_backend()
+
+if __name__ == "__main__":
+    # python state.py - перенос локальных данных в Redis из REDIS_URL
+    async def _import():
+        target = RedisStateBackend()
+        try:
+            await import_local_state(target)
+        finally:
+            await target.close()
+    
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_import())
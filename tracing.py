@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import secrets
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Файл для спанов в формате JSON lines (по умолчанию трассировка выключена)
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+
+# Доля обновлений, трассы которых записываются всегда (head sampling)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+
+# Обновления дольше порога (секунды) записываются целиком и попадают в журнал медленных запросов.
+# Трасса включает ход LLM (обычно 20-40 секунд), поэтому порог выше обычного ответа
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", 60))
+
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "alice-bot")
+
+# Коды статуса и вид спана в OTLP
+STATUS_OK = 1
+STATUS_ERROR = 2
+SPAN_KIND_INTERNAL = 1
+
+_current = contextvars.ContextVar("current_span", default=None)
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+class Trace:
+    """
+    Спаны одного обновления. Записываются все спаны, а решение о выгрузке
+    принимается, когда закрыт последний из них: выборка по head sampling
+    или превышение порога длительности.
+    """
+
+    def __init__(self, sampled: bool):
+        self.trace_id = secrets.token_hex(16)
+        self.sampled = sampled
+        self.spans = []
+        self.open = 0
+        self.finished = False
+        self.root = None
+
+    def _finish(self):
+        self.finished = True
+        # Корневой спан может закрыться раньше фоновой работы (ответа LLM), поэтому длительность - по последнему спану
+        duration = max(span.ended for span in self.spans) - self.root.started
+        slow = duration >= TRACE_SLOW_THRESHOLD
+        if slow:
+            breakdown = ", ".join(
+                f"{span.name}={span.duration * 1000:.0f}ms" for span in self.spans if span is not self.root
+            )
+            logger.warning(f"Slow update: {self.root.name} took {duration:.2f}s (trace {self.trace_id}): {breakdown}")
+        if self.sampled or slow:
+            trace_exporter.export(self)
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "start_ns", "end_ns",
+                 "started", "ended", "status", "status_message")
+
+    def __init__(self, trace: Trace, name: str, parent_id: str = "", attributes: dict = None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.started = time.perf_counter()
+        self.ended = None
+        self.status = STATUS_OK
+        self.status_message = ""
+        trace.spans.append(self)
+        trace.open += 1
+
+    @property
+    def duration(self) -> float:
+        return (self.ended if self.ended is not None else time.perf_counter()) - self.started
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error: BaseException = None):
+        if self.ended is not None or self.trace.finished:
+            return
+        self.ended = time.perf_counter()
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.status = STATUS_ERROR
+            self.status_message = repr(error)
+        self.trace.open -= 1
+        if self.trace.open == 0:
+            self.trace._finish()
+
+    async def httpx_hook(self, event_name: str, info: dict):
+        """Хук трассировки httpx: время установления соединения и до первого байта ответа"""
+        if event_name.endswith(("connect_tcp.complete", "start_tls.complete")):
+            self.attributes["http.connect_ms"] = round(self.elapsed_ms(), 1)
+        elif event_name.endswith("receive_response_headers.complete"):
+            self.attributes["http.ttfb_ms"] = round(self.elapsed_ms(), 1)
+
+    def to_otlp(self) -> dict:
+        return {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "kind": SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": self.status, "message": self.status_message}
+        }
+
+class _NoopSpan:
+    """Спан вне трассы: все операции ничего не делают"""
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error: BaseException = None):
+        pass
+
+    def elapsed_ms(self) -> float:
+        return 0.0
+
+    async def httpx_hook(self, event_name: str, info: dict):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+def current_span():
+    span = _current.get()
+    return span if span is not None else NOOP_SPAN
+
+def start_span(name: str, **attributes):
+    """Дочерний спан текущего (не становится текущим); закрывается вызовом end()"""
+    parent = _current.get()
+    if parent is None or parent.trace.finished:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+@contextmanager
+def use_span(span):
+    """Сделать спан текущим (например, в задаче, продолжающей обработку обновления)"""
+    if span is NOOP_SPAN:
+        span = None
+    token = _current.set(span)
+    try:
+        yield span if span is not None else NOOP_SPAN
+    finally:
+        _current.reset(token)
+
+@contextmanager
+def span(name: str, **attributes):
+    """Спан на время блока; исключение отмечается статусом ошибки"""
+    child = start_span(name, **attributes)
+    with use_span(child):
+        try:
+            yield child
+        except BaseException as e:
+            child.end(e)
+            raise
+        child.end()
+
+@contextmanager
+def start_trace(name: str, **attributes):
+    """Корневой спан новой трассы (одно обновление Telegram)"""
+    if not TRACE_FILE:
+        yield NOOP_SPAN
+        return
+    trace = Trace(sampled=random.random() < TRACE_SAMPLE_RATE)
+    root = trace.root = Span(trace, name, attributes=attributes)
+    with use_span(root):
+        try:
+            yield root
+        except BaseException as e:
+            root.end(e)
+            raise
+        root.end()
+
+def traced(name: str = None):
+    """Декоратор: спан на время вызова синхронной функции"""
+    def decorator(func):
+        span_name = name or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class TraceExporter:
+    """Запись трасс в файл в отдельном потоке: одна строка - OTLP JSON (resourceSpans) одной трассы"""
+
+    def __init__(self, path: str = TRACE_FILE, max_queue: int = 10000):
+        self.path = path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def export(self, trace: Trace):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            logger.warning(f"Trace export queue is full, dropping trace {trace.trace_id}")
+
+    def _line(self, trace: Trace) -> str:
+        return json.dumps({
+            "resourceSpans": [{
+                "resource": {"attributes": [_attribute("service.name", TRACE_SERVICE_NAME)]},
+                "scopeSpans": [{
+                    "scope": {"name": "bot"},
+                    "spans": [span.to_otlp() for span in trace.spans]
+                }]
+            }]
+        }, ensure_ascii=False)
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            if trace is None:
+                return
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(self._line(trace) + "\n")
+                    # Забираем все накопившиеся трассы одной записью
+                    while True:
+                        try:
+                            trace = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if trace is None:
+                            return
+                        f.write(self._line(trace) + "\n")
+            except Exception as e:
+                logger.error(f"Error writing traces to {self.path}: {e}")
+
+    def stop(self):
+        """Запись оставшихся трасс (при остановке бота)"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+trace_exporter = TraceExporter()
+atexit.register(trace_exporter.stop)
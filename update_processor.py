@@ -0,0 +1,114 @@
+import os
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Максимальное число одновременно обрабатываемых обновлений
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
+
+# Лимит семафора PTB: заведомо выше собственного, чтобы он никогда не срабатывал первым
+PTB_MAX_CONCURRENT_UPDATES = 1_000_000
+
+def ordering_key(update: object):
+    """Ключ упорядочивания: чат, а без чата - пользователь (None - без ограничений)"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return ("chat", update.effective_chat.id)
+    if update.effective_user is not None:
+        return ("user", update.effective_user.id)
+    return None
+
+def raw_chat_id(data: dict):
+    """Чат (или пользователь) необработанного обновления Telegram в формате JSON"""
+    for field, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user and "id" in user:
+            return user["id"]
+    return None
+
+def shard_index(data: dict, shards: int) -> int:
+    """Номер рабочего процесса для обновления: все обновления чата попадают в один процесс"""
+    chat_id = raw_chat_id(data)
+    if chat_id is None:
+        return 0
+    return chat_id % shards
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений разных чатов с сохранением порядка
+    внутри чата: обновления одного чата выполняются строго по очереди,
+    поэтому история диалога и состояние ConversationHandler остаются согласованными.
+    """
+
+    def __init__(self, max_concurrent_updates: int = CONCURRENT_UPDATES):
+        # Семафор PTB не должен ограничивать раньше замка чата (иначе очередь одного
+        # чата занимает общие слоты), поэтому лимит параллельности - собственный
+        super().__init__(PTB_MAX_CONCURRENT_UPDATES)
+        self.max_running = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # Ключ -> [замок, число обновлений, ожидающих или выполняющихся под ним]
+        self._locks = {}
+        self._running = 0
+
+    async def do_process_update(self, update: object, coroutine):
+        attributes = {}
+        if isinstance(update, Update):
+            attributes["update_id"] = update.update_id
+            if update.effective_chat is not None:
+                attributes["chat_id"] = update.effective_chat.id
+        # Корневой спан трассы включает ожидание очереди чата и общего семафора
+        with tracing.start_trace("telegram.update", **attributes) as root:
+            key = ordering_key(update)
+            if key is None:
+                await self._run(root, coroutine)
+                return
+
+            # Замок чата берется до общего семафора
+            slot = self._locks.get(key)
+            if slot is None:
+                slot = self._locks[key] = [asyncio.Lock(), 0]
+            slot[1] += 1
+            try:
+                async with slot[0]:
+                    await self._run(root, coroutine)
+            finally:
+                slot[1] -= 1
+                if slot[1] == 0:
+                    del self._locks[key]
+
+    async def _run(self, root, coroutine):
+        async with self._slots:
+            self._running += 1
+            try:
+                with tracing.span("update.handle", wait_ms=round(root.elapsed_ms(), 1)):
+                    await coroutine
+            finally:
+                self._running -= 1
+
+    @property
+    def running(self) -> int:
+        """Число обновлений, обрабатываемых прямо сейчас"""
+        return self._running
+
+    @property
+    def ordered_keys(self) -> int:
+        """Число чатов, у которых есть обновления в обработке или в очереди"""
+        return len(self._locks)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,99 @@
+import os
+import hmac
+import logging
+import threading
+
+from flask import Flask, request, abort, jsonify
+from waitress import serve
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Число рабочих потоков waitress
+WEB_THREADS = int(os.getenv("WEB_THREADS", 8))
+
+# Путь и секрет вебхука Telegram
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+app = Flask(__name__)
+
+class Readiness:
+    """Состояние проверок готовности (БД, Telegram, провайдер LLM, получение обновлений)"""
+
+    def __init__(self, checks=()):
+        self._checks = {name: False for name in checks}
+        self._lock = threading.Lock()
+
+    def set(self, name: str, ok: bool = True):
+        with self._lock:
+            self._checks[name] = ok
+
+    def reset(self):
+        with self._lock:
+            for name in self._checks:
+                self._checks[name] = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._checks)
+
+    @property
+    def ready(self) -> bool:
+        checks = self.snapshot()
+        return bool(checks) and all(checks.values())
+
+readiness = Readiness(("database", "telegram", "llm_provider", "updates"))
+
+# Обработчик входящих обновлений и его секрет (задаются ботом в режиме вебхука)
+_update_handler = None
+_webhook_secret = WEBHOOK_SECRET
+
+def set_update_handler(handler, secret: str = WEBHOOK_SECRET):
+    global _update_handler, _webhook_secret
+    _update_handler = handler
+    _webhook_secret = secret
+
+# Проверка работоспособности (liveness): процесс жив и отвечает
+@app.route("/", methods=["GET", "HEAD"])
+@app.route("/healthz", methods=["GET", "HEAD"])
+def health():
+    return "Service is alive", 200, {"Content-Type": "text/plain"}
+
+# Проверка готовности (readiness): бот принимает и обрабатывает обновления
+@app.route("/readyz", methods=["GET", "HEAD"])
+def ready():
+    status = 200 if readiness.ready else 503
+    return jsonify(ready=status == 200, checks=readiness.snapshot()), status
+
+# Метрики в текстовом формате Prometheus
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return REGISTRY.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# Прием обновлений Telegram
+@app.route(f"/{WEBHOOK_PATH}", methods=["POST"])
+def webhook():
+    if _update_handler is None:
+        abort(503)
+
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if _webhook_secret and not hmac.compare_digest(token, _webhook_secret):
+        logger.warning(f"Rejected webhook request with invalid secret from {request.remote_addr}")
+        abort(403)
+
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+
+    try:
+        _update_handler(data)
+    except Exception as e:
+        logger.error(f"Error enqueuing webhook update: {e}")
+        abort(500)
+    return "", 200
+
+def run_http_server(port=8080, threads=WEB_THREADS):
+    logger.info(f"Starting HTTP server on port {port} ({threads} threads)")
+    serve(app, host="0.0.0.0", port=port, threads=threads)